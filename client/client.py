@@ -4,11 +4,16 @@ import argparse
 import fetcher
 import json
 import lib
-import os
+import peer
+import queue
+import random
 import socket
 import subprocess
+import threading
 import time
 import update_grub
+import wire
+from ws4py import messaging
 from ws4py.client import threadedclient
 
 
@@ -28,6 +33,24 @@ parser.add_argument(
     dest='ca_cert',
     action='store',
     required=True)
+parser.add_argument(
+    '--fetch-workers',
+    dest='fetch_workers',
+    action='store',
+    type=int,
+    default=4)
+parser.add_argument(
+    '--heartbeat-seconds',
+    dest='heartbeat_seconds',
+    action='store',
+    type=float,
+    default=20.0)
+parser.add_argument(
+    '--heartbeat-timeout-seconds',
+    dest='heartbeat_timeout_seconds',
+    action='store',
+    type=float,
+    default=60.0)
 parser.add_argument(
     '--https-ca-cert',
     dest='https_ca_cert',
@@ -48,6 +71,34 @@ parser.add_argument(
     dest='image_dir',
     action='store',
     required=True)
+parser.add_argument(
+    '--peer-discovery-port',
+    dest='peer_discovery_port',
+    action='store',
+    type=int,
+    default=4430)
+parser.add_argument(
+    '--peer-group',
+    dest='peer_group',
+    action='store',
+    default='239.255.44.30')
+parser.add_argument(
+    '--peer-interface',
+    dest='peer_interface',
+    action='store',
+    default='0.0.0.0')
+parser.add_argument(
+    '--peer-port',
+    dest='peer_port',
+    action='store',
+    type=int,
+    default=0)
+parser.add_argument(
+    '--reconnect-seconds',
+    dest='reconnect_seconds',
+    action='store',
+    type=float,
+    default=30.0)
 parser.add_argument(
     '--server',
     dest='server',
@@ -60,31 +111,166 @@ class Client(threadedclient.WebSocketClient):
 
   def __init__(self, config_path, *args, **kwargs):
     super().__init__(*args, **kwargs)
+    self._connect_args = (args, kwargs)
+    self._socket_used = False
     with open(config_path, 'r') as fh:
       self._config = json.load(fh)
+    self._fetcher = None
+    self._codec = None
+    self._last_report = None
+    self._report_lock = threading.Lock()
+    self._report_interval = 5.0
+    self._report_interval_changed = threading.Event()
+    self._reconnect_after = None
+    self._last_seen = None
+    # Reports, commands and heartbeats are sent from different threads, and
+    # ws4py sends pongs and close replies from the reader thread. Reentrant,
+    # since send() comes back through _write() with it held.
+    self._send_lock = threading.RLock()
+    # Fetches can outlast heartbeat_timeout_seconds, so they run here rather
+    # than on ws4py's reader thread, which has to keep reading meanwhile.
+    self._tasks = queue.Queue()
+
+  def process_handshake_header(self, headers):
+    # connect() can hand frames that arrived with the handshake response to
+    # received_message() before opened() runs, so pick the codec here.
+    protocols, extensions = super().process_handshake_header(headers)
+    self._codec = wire.Codec.ForProtocols(protocols)
+    self._last_seen = time.monotonic()
+    return protocols, extensions
+
+  def process(self, data):
+    # Any frame counts as a sign of life, including pongs to our pings.
+    self._last_seen = time.monotonic()
+    return super().process(data)
+
+  def _write(self, b):
+    with self._send_lock:
+      super()._write(b)
+
+  def closed(self, code, reason=None):
+    # Wakes the report loop so it can reconnect.
+    self._report_interval_changed.set()
 
   def Loop(self):
+    threading.Thread(target=self._TaskLoop, daemon=True).start()
+    threading.Thread(target=self._HeartbeatLoop, daemon=True).start()
+    while True:
+      try:
+        self._Connect()
+      except Exception as e:
+        print('Connect failed: %s' % e, flush=True)
+        time.sleep(random.uniform(0, FLAGS.reconnect_seconds))
+        continue
+      # Catches up on any new_manifest sent while we were away.
+      self._tasks.put(self._UpdateManifest)
+      try:
+        while not self.terminated:
+          if time.monotonic() - self._last_seen > FLAGS.heartbeat_timeout_seconds:
+            # Half-open: sends still succeed, but nothing comes back.
+            print('Nothing from server in %ds' % FLAGS.heartbeat_timeout_seconds, flush=True)
+            break
+          self._SendReport()
+          self._WaitForNextReport()
+      except (OSError, RuntimeError) as e:
+        print('Connection lost: %s' % e, flush=True)
+      # Wait for the reader thread to finish with this socket before
+      # _Connect() replaces it.
+      self.close_connection()
+      self._th.join()
+      # A restarting server tells each client how long to wait, so they
+      # don't all come back at once. Otherwise pick our own random delay.
+      delay = self._reconnect_after
+      if delay is None:
+        delay = random.uniform(0, FLAGS.reconnect_seconds)
+      time.sleep(delay)
+
+  def _TaskLoop(self):
+    # A failure here mustn't stop us reporting or reconnecting; the next
+    # new_manifest or reconnect tries again.
+    while True:
+      task = self._tasks.get()
+      try:
+        task()
+      except Exception as e:
+        print('Task failed: %s' % e, flush=True)
+
+  def _HeartbeatLoop(self):
+    # ws4py's heartbeat_freq only sends unsolicited pongs, which get no
+    # answer. A ping does, which keeps _last_seen fresh while the server has
+    # nothing else to say.
+    while True:
+      time.sleep(FLAGS.heartbeat_seconds)
+      if self._codec is None or self.terminated:
+        continue
+      try:
+        with self._send_lock:
+          self.send(messaging.PingControlMessage(b''))
+      except (OSError, RuntimeError):
+        # The report loop notices and reconnects.
+        pass
+
+  def _Connect(self):
+    if self._socket_used:
+      # ws4py clients can't reconnect, so start over with a fresh socket.
+      args, kwargs = self._connect_args
+      super().__init__(*args, **kwargs)
+    self._socket_used = True
+    self._codec = None
+    self._last_report = None
+    self._reconnect_after = None
+    self._report_interval_changed.clear()
     self.daemon = True
     self.connect()
-    self._UpdateManifest()
-    while True:
-      self._SendReport()
-      time.sleep(5.0)
+
+  def _WaitForNextReport(self):
+    # Jitter keeps hosts from reporting in lockstep. After an interval
+    # change, start at a random point in the new interval, so hosts told at
+    # the same moment don't all report at the same moment.
+    if self._report_interval_changed.wait(self._report_interval * random.uniform(0.9, 1.1)):
+      self._report_interval_changed.clear()
+      if not self.terminated:
+        time.sleep(random.uniform(0, self._report_interval))
+
+  def _Send(self, msg_type, data=None, **kwargs):
+    msg = {
+      'type': msg_type,
+    }
+    if data is not None:
+      msg['data'] = data
+    msg.update(kwargs)
+    with self._send_lock:
+      self.send(self._codec.Encode(msg), binary=self._codec.binary)
 
   def _SendReport(self, status=None):
+    # After the first full report, only send fields that changed, or a bare
+    # heartbeat if nothing did. The server merges these back into the full
+    # report and extrapolates uptime_seconds, which we only send once.
     report = {
       'hostname': socket.gethostname(),
-      'uptime_seconds': self._Uptime(),
       'next_timestamp': self._NextTimestamp(),
       'next_volume_id': lib.GetVolumeID('/isodevice/iconograph/current'),
     }
     if status:
       report['status'] = status
     report.update(self._config)
-    self.send(json.dumps({
-      'type': 'report',
-      'data': report,
-    }))
+
+    with self._report_lock:
+      if self._last_report is None:
+        full_report = dict(report)
+        full_report['uptime_seconds'] = self._Uptime()
+        self._Send('report', full_report)
+      else:
+        changed = dict(
+            (key, value)
+            for key, value in report.items()
+            if self._last_report.get(key) != value)
+        removed = [key for key in self._last_report if key not in report]
+        if changed or removed:
+          self._Send('report_delta', changed, removed=removed)
+        else:
+          self._Send('heartbeat')
+      self._last_report = report
 
   def _Uptime(self):
     with open('/proc/uptime', 'r') as fh:
@@ -94,22 +280,39 @@ class Client(threadedclient.WebSocketClient):
     next_image = lib.GetCurrentImage()
     return int(next_image.split('.', 1)[0])
 
+  def _OnReportInterval(self, data):
+    if data['seconds'] != self._report_interval:
+      self._report_interval = data['seconds']
+      self._report_interval_changed.set()
+
   def _OnImageTypes(self, data):
     assert self._config['image_type'] in data['image_types']
 
   def _OnNewManifest(self, data):
     if data['image_type'] != self._config['image_type']:
       return
-    self._UpdateManifest()
+    self._tasks.put(lambda: self._UpdateManifest(data.get('manifest'), data.get('etag')))
 
   def _GetFetcher(self):
-    return fetcher.Fetcher(
+    # Reused across updates so verified signing chains stay cached
+    if self._fetcher:
+      return self._fetcher
+    peer_finder = None
+    if FLAGS.peer_port:
+      peer_finder = peer.PeerFinder(
+          FLAGS.peer_group,
+          FLAGS.peer_discovery_port,
+          FLAGS.peer_interface)
+    self._fetcher = fetcher.Fetcher(
         'https://%s/image/%s' % (FLAGS.server, self._config['image_type']),
         FLAGS.ca_cert,
         FLAGS.image_dir,
         FLAGS.https_ca_cert,
         FLAGS.https_client_cert,
-        FLAGS.https_client_key)
+        FLAGS.https_client_key,
+        num_workers=FLAGS.fetch_workers,
+        peer_finder=peer_finder)
+    return self._fetcher
 
   def _UpdateGrub(self):
     update = update_grub.GrubUpdater(
@@ -117,15 +320,15 @@ class Client(threadedclient.WebSocketClient):
         FLAGS.boot_dir)
     update.Update()
 
-  def _UpdateManifest(self):
+  def _UpdateManifest(self, pushed_manifest=None, pushed_etag=None):
     fetch = self._GetFetcher()
-    fetch.Fetch()
+    fetch.Fetch(pushed_manifest=pushed_manifest, pushed_etag=pushed_etag)
     fetch.DeleteOldImages(skip={'%d.iso' % self._config['timestamp']})
     self._UpdateGrub()
 
   def _OnCommand(self, data):
     if data['command'] == 'reboot':
-      self._OnReboot(data)
+      self._tasks.put(lambda: self._OnReboot(data))
 
   def _OnReboot(self, data):
     if 'timestamp' in data:
@@ -139,16 +342,32 @@ class Client(threadedclient.WebSocketClient):
     subprocess.check_call(['reboot'])
 
   def received_message(self, msg):
-    parsed = json.loads(msg.data.decode('utf8'))
+    parsed = self._codec.Decode(msg.data)
     if parsed['type'] == 'image_types':
       self._OnImageTypes(parsed['data'])
     elif parsed['type'] == 'new_manifest':
       self._OnNewManifest(parsed['data'])
     elif parsed['type'] == 'command':
       self._OnCommand(parsed['data'])
+    elif parsed['type'] == 'report_interval':
+      self._OnReportInterval(parsed['data'])
+    elif parsed['type'] == 'reconnect_after':
+      self._reconnect_after = parsed['data']['seconds']
 
 
 def main():
+  if FLAGS.peer_port:
+    peer_server = peer.PeerServer(
+        FLAGS.image_dir,
+        FLAGS.peer_port,
+        FLAGS.peer_group,
+        FLAGS.peer_discovery_port,
+        FLAGS.peer_interface,
+        FLAGS.https_ca_cert,
+        FLAGS.https_client_cert,
+        FLAGS.https_client_key)
+    peer_server.Start()
+
   ssl_options = {
     'keyfile': FLAGS.https_client_key,
     'certfile': FLAGS.https_client_cert,
@@ -157,7 +376,7 @@ def main():
   client = Client(
       FLAGS.config,
       'wss://%s/ws/slave' % FLAGS.server,
-      protocols=['iconograph-slave'],
+      protocols=wire.Codec.Protocols(),
       ssl_options=ssl_options)
   client.Loop()
 
@@ -0,0 +1,165 @@
+import array
+import hashlib
+import zlib
+
+
+# Block index format, shared by build_manifest.py (which publishes it) and
+# fetcher.py (which assembles new images from local ones):
+#
+#   {
+#     "block_size": 65536,
+#     "sector_size": 2048,
+#     "size": <image size in bytes>,
+#     "blocks": [[<weak hash>, <sha256 hex>], ...],
+#   }
+#
+# Only full blocks are indexed; the tail is always fetched. Weak hashes are
+# rsync-style rolling checksums. Scanning local images byte-by-byte in Python
+# would take hours, so we roll a sector (the ISO9660 allocation unit) at a
+# time instead, which still finds every file that didn't change.
+
+BLOCK_SIZE = 2 ** 16
+SECTOR_SIZE = 2 ** 11
+
+_MOD = 65521
+_SECTORS_PER_BLOCK = BLOCK_SIZE // SECTOR_SIZE
+
+
+def _SectorSums(data):
+  # zlib's adler32 is the rsync checksum with a +1 seed; undo the seed to get
+  # (a, b) for this sector while doing the per-byte work in C.
+  adler = zlib.adler32(data)
+  a = ((adler & 0xffff) - 1) % _MOD
+  b = ((adler >> 16) - len(data)) % _MOD
+  return a, b
+
+
+def _Append(a, b, sector_a, sector_b):
+  b = (b + SECTOR_SIZE * a + sector_b) % _MOD
+  a = (a + sector_a) % _MOD
+  return a, b
+
+
+def _Weak(a, b):
+  return (b << 16) | a
+
+
+def WeakHash(data):
+  a = b = 0
+  for i in range(0, len(data), SECTOR_SIZE):
+    a, b = _Append(a, b, *_SectorSums(data[i:i + SECTOR_SIZE]))
+  return _Weak(a, b)
+
+
+def StrongHash(data):
+  return hashlib.sha256(data).hexdigest()
+
+
+class BlockIndexBuilder(object):
+
+  def __init__(self):
+    self._size = 0
+    self._blocks = []
+
+  def Update(self, data):
+    # Callers must pass BLOCK_SIZE chunks; only the last may be short.
+    self._size += len(data)
+    if len(data) == BLOCK_SIZE:
+      self._blocks.append([WeakHash(data), StrongHash(data)])
+
+  def Index(self):
+    return {
+      'block_size': BLOCK_SIZE,
+      'sector_size': SECTOR_SIZE,
+      'size': self._size,
+      'blocks': self._blocks,
+    }
+
+
+def _ReadSectorSums(fh):
+  sums_a = array.array('L')
+  sums_b = array.array('L')
+  while True:
+    data = fh.read(BLOCK_SIZE)
+    if not data:
+      break
+    for i in range(0, len(data) - SECTOR_SIZE + 1, SECTOR_SIZE):
+      a, b = _SectorSums(data[i:i + SECTOR_SIZE])
+      sums_a.append(a)
+      sums_b.append(b)
+  return sums_a, sums_b
+
+
+def _Window(sums_a, sums_b, start):
+  a = b = 0
+  for i in range(start, start + _SECTORS_PER_BLOCK):
+    a, b = _Append(a, b, sums_a[i], sums_b[i])
+  return a, b
+
+
+def _ScanFile(path, index, weak_map, found):
+  blocks = index['blocks']
+  with open(path, 'rb') as fh:
+    sums_a, sums_b = _ReadSectorSums(fh)
+    last = len(sums_a) - _SECTORS_PER_BLOCK
+    if last < 0:
+      return
+
+    pos = 0
+    a, b = _Window(sums_a, sums_b, pos)
+    while True:
+      matched = False
+      candidates = weak_map.get(_Weak(a, b))
+      if candidates and any(num not in found for num in candidates):
+        fh.seek(pos * SECTOR_SIZE)
+        strong = StrongHash(fh.read(BLOCK_SIZE))
+        for num in candidates:
+          if num not in found and blocks[num][1] == strong:
+            found[num] = (path, pos * SECTOR_SIZE)
+            matched = True
+
+      if matched and pos + _SECTORS_PER_BLOCK <= last:
+        pos += _SECTORS_PER_BLOCK
+        a, b = _Window(sums_a, sums_b, pos)
+        continue
+      if pos >= last:
+        break
+
+      # Roll one sector forward
+      first_a, first_b = sums_a[pos], sums_b[pos]
+      b = (b - first_b - (_SECTORS_PER_BLOCK - 1) * SECTOR_SIZE * first_a) % _MOD
+      a = (a - first_a) % _MOD
+      a, b = _Append(a, b, sums_a[pos + _SECTORS_PER_BLOCK], sums_b[pos + _SECTORS_PER_BLOCK])
+      pos += 1
+
+
+def FindLocalBlocks(index, paths):
+  # Returns {block number: (path, offset)} for blocks found in local files.
+  weak_map = {}
+  for num, (weak, strong) in enumerate(index['blocks']):
+    weak_map.setdefault(weak, []).append(num)
+
+  found = {}
+  for path in paths:
+    if len(found) == len(index['blocks']):
+      break
+    _ScanFile(path, index, weak_map, found)
+  return found
+
+
+def MissingRanges(index, found):
+  # Yields inclusive (start, end) byte ranges that must be fetched.
+  size = index['size']
+  start = None
+  for num in range(len(index['blocks'])):
+    if num in found:
+      if start is not None:
+        yield (start, num * BLOCK_SIZE - 1)
+        start = None
+    elif start is None:
+      start = num * BLOCK_SIZE
+  tail = len(index['blocks']) * BLOCK_SIZE
+  if start is None and tail < size:
+    start = tail
+  if start is not None:
+    yield (start, size - 1)
@@ -1,19 +1,27 @@
 #!/usr/bin/python3
 
+import calendar
 import codecs
+import delta
 import json
 import hashlib
 import os
+import queue
 import re
 import requests
-import shutil
 import socket
 import struct
-import subprocess
 import tempfile
+import threading
+import time
+import urllib3
 from OpenSSL import crypto
 
 
+# Peer connections aren't authenticated (see peer.py); don't warn about it
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
 class Error(Exception):
   pass
 
@@ -30,49 +38,73 @@ class ManifestTimeRegressed(Error):
   pass
 
 
+class RangeNotSupported(Error):
+  pass
+
+
 class Fetcher(object):
 
   _BUF_SIZE = 2 ** 16
   _MAX_BP = 10000
   _FILE_REGEX = re.compile('^(?P<timestamp>\d+)\.iso$')
+  _PARTIAL_REGEX = re.compile('^(?P<timestamp>\d+)\.iso\.(partial|journal)$')
+  _CONTENT_RANGE_REGEX = re.compile('^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<size>\d+)$')
+  _PEM_CERT_REGEX = re.compile('-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----\n?', re.DOTALL)
+  _JOURNAL_INTERVAL = 2 ** 24
+  _MAX_CHUNK_ATTEMPTS = 3
 
-  def __init__(self, base_url, ca_cert, image_dir, https_ca_cert, https_client_cert, https_client_key):
+  def __init__(self, base_url, ca_cert, image_dir, https_ca_cert, https_client_cert, https_client_key, num_workers=4, peer_finder=None):
     self._base_url = base_url
-    self._ca_cert_path = ca_cert
+    self._ca_store, self._ca_expires = self._LoadCAStore(ca_cert)
+    self._verified_chains = {}
     self._image_dir = image_dir
-    self._session = requests.Session()
-    if https_ca_cert:
-      self._session.verify = https_ca_cert
-    if https_client_cert and https_client_key:
-      self._session.cert = (https_client_cert, https_client_key)
-
-  def _VerifyChain(self, untrusted_certs, cert):
-    tempdir = tempfile.mkdtemp()
-
-    try:
-      untrusted_path = os.path.join(tempdir, 'untrusted.pem')
-      with open(untrusted_path, 'w') as fh:
-        for cert_str in untrusted_certs:
-          fh.write(cert_str)
-
-      cert_path = os.path.join(tempdir, 'cert.pem')
-      with open(cert_path, 'w') as fh:
-        fh.write(cert)
-
-      # Rely on pipe buffering to eat the stdout junk
-      subprocess.check_call([
-          'openssl', 'verify',
-          '-CAfile', self._ca_cert_path,
-          '-untrusted', untrusted_path,
-          cert_path,
-      ], stdout=subprocess.PIPE)
-    finally:
-      shutil.rmtree(tempdir)
+    self._https_ca_cert = https_ca_cert
+    self._https_client_cert = https_client_cert
+    self._https_client_key = https_client_key
+    self._num_workers = num_workers
+    self._peer_finder = peer_finder
+    self._session = self._NewSession()
+    # Partial and journal paths are fixed per image, so two overlapping
+    # fetches would write over each other's downloads.
+    self._fetch_lock = threading.Lock()
+
+  def _LoadCAStore(self, ca_cert):
+    store = crypto.X509Store()
+    with open(ca_cert, 'r') as fh:
+      ca_certs = [
+          crypto.load_certificate(crypto.FILETYPE_PEM, cert_str)
+          for cert_str in self._PEM_CERT_REGEX.findall(fh.read())
+      ]
+    for cert in ca_certs:
+      store.add_cert(cert)
+    return store, min(self._NotAfter(cert) for cert in ca_certs)
+
+  def _NotAfter(self, cert):
+    return calendar.timegm(time.strptime(cert.get_notAfter().decode('ascii'), '%Y%m%d%H%M%SZ'))
+
+  def _VerifyChain(self, untrusted_certs, cert_str):
+    cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_str)
+    chain = [
+        crypto.load_certificate(crypto.FILETYPE_PEM, untrusted_str)
+        for untrusted_str in untrusted_certs
+    ]
+
+    # Manifests are re-signed by the same chain every time, so remember
+    # chains we've verified until the first cert in them expires.
+    key = tuple(x.digest('sha256') for x in [cert] + chain)
+    expires = self._verified_chains.get(key)
+    if expires and time.time() < expires:
+      return cert
+
+    context = crypto.X509StoreContext(self._ca_store, cert, chain)
+    context.verify_certificate()
+
+    self._verified_chains[key] = min(
+        [self._ca_expires] + [self._NotAfter(x) for x in [cert] + chain])
+    return cert
 
   def _Unwrap(self, wrapped):
-    self._VerifyChain(wrapped.get('other_certs', []), wrapped['cert'])
-
-    cert = crypto.load_certificate(crypto.FILETYPE_PEM, wrapped['cert'])
+    cert = self._VerifyChain(wrapped.get('other_certs', []), wrapped['cert'])
     sig = codecs.decode(wrapped['sig'], 'hex')
     crypto.verify(
         cert,
@@ -82,11 +114,47 @@ class Fetcher(object):
 
     return json.loads(wrapped['inner'])
 
-  def _GetManifest(self):
+  def _GetManifest(self, pushed_manifest=None, pushed_etag=None):
+    # pushed_manifest is a signed manifest the server sent over the
+    # WebSocket. It gets the same checks as one fetched over HTTP.
     url = '%s/manifest.json' % (self._base_url)
-    resp = self._session.get(url)
-    unwrapped = self._Unwrap(resp.json())
+    path = os.path.join(self._image_dir, 'manifest.json')
+    etag_path = os.path.join(self._image_dir, 'manifest.json.etag')
+
+    # An unchanged manifest costs a 304 and no signature checks; the cached
+    # copy was verified when we stored it.
+    cached_etag = None
+    try:
+      with open(etag_path, 'r') as fh:
+        if os.path.exists(path):
+          cached_etag = fh.read().strip()
+    except FileNotFoundError:
+      pass
+
+    if pushed_manifest:
+      if pushed_etag and pushed_etag == cached_etag:
+        with open(path, 'r') as fh:
+          return json.load(fh)
+      wrapped, etag = pushed_manifest, pushed_etag
+    else:
+      headers = {}
+      if cached_etag:
+        headers['If-None-Match'] = cached_etag
+      resp = self._session.get(url, headers=headers)
+      if resp.status_code == 304:
+        with open(path, 'r') as fh:
+          return json.load(fh)
+      resp.raise_for_status()
+      wrapped, etag = resp.json(), resp.headers.get('ETag')
+
+    unwrapped = self._Unwrap(wrapped)
     self._ValidateManifest(unwrapped)
+
+    if etag:
+      with open(etag_path, 'w') as fh:
+        fh.write(etag)
+    else:
+      self._Unlink(etag_path)
     return unwrapped
 
   def _ValidateManifest(self, new_manifest):
@@ -124,6 +192,307 @@ class Fetcher(object):
         return image
     raise NoValidImage
 
+  def _NewSession(self):
+    session = requests.Session()
+    if self._https_ca_cert:
+      session.verify = self._https_ca_cert
+    if self._https_client_cert and self._https_client_key:
+      session.cert = (self._https_client_cert, self._https_client_key)
+    return session
+
+  def _ReadJournal(self, image, journal_path):
+    try:
+      with open(journal_path, 'r') as fh:
+        journal = json.load(fh)
+    except (FileNotFoundError, ValueError):
+      return None
+    if journal.get('hash') != image['hash']:
+      return None
+    return journal
+
+  def _WriteJournal(self, image, journal_path, **values):
+    journal = {
+      'hash': image['hash'],
+    }
+    journal.update(values)
+    with tempfile.NamedTemporaryFile('w', dir=self._image_dir, delete=False) as fh:
+      try:
+        json.dump(journal, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+        os.rename(fh.name, journal_path)
+      except:
+        os.unlink(fh.name)
+        raise
+
+  def _ResumeOffset(self, journal, partial_path, hash_obj):
+    # hashlib can't serialize its internal state, so the journal records the
+    # digest of the verified prefix instead. We re-hash that prefix from local
+    # disk (cheap compared to the network) and resume only if it still matches.
+    if not journal or 'offset' not in journal:
+      return 0
+
+    offset = journal['offset']
+    try:
+      with open(partial_path, 'rb') as fh:
+        remaining = offset
+        while remaining:
+          data = fh.read(min(self._BUF_SIZE, remaining))
+          if not data:
+            return 0
+          hash_obj.update(data)
+          remaining -= len(data)
+    except FileNotFoundError:
+      return 0
+
+    if hash_obj.hexdigest() != journal['prefix_hash']:
+      return 0
+
+    return offset
+
+  def _GetBlockIndex(self, image):
+    url = '%s/%d.blocks.json' % (self._base_url, image['timestamp'])
+    resp = self._session.get(url)
+    resp.raise_for_status()
+    if hashlib.sha256(resp.content).hexdigest() != image['block_index_hash']:
+      raise InvalidHash
+    return json.loads(resp.content.decode('utf8'))
+
+  def _FetchRange(self, session, url, start, end, size, **kwargs):
+    # Bytes start..end of a size-byte file. Anything but exactly that range,
+    # e.g. from a proxy that ignored the requested end, is RangeNotSupported
+    # rather than data written over the neighbouring range.
+    resp = session.get(
+        url,
+        headers={'Range': 'bytes=%d-%d' % (start, end)},
+        stream=True,
+        **kwargs)
+    resp.raise_for_status()
+    match = self._CONTENT_RANGE_REGEX.match(resp.headers.get('Content-Range', ''))
+    if (resp.status_code != 206 or
+        not match or
+        int(match.group('start')) != start or
+        int(match.group('end')) != end or
+        int(match.group('size')) != size):
+      resp.close()
+      raise RangeNotSupported
+    return self._LimitBody(resp, end + 1 - start)
+
+  def _LimitBody(self, resp, length):
+    # Peers aren't authenticated, and a matching Content-Range says nothing
+    # about how much body follows it. Stop before anything past length gets
+    # written over a neighbouring range.
+    remaining = length
+    for data in resp.iter_content(self._BUF_SIZE):
+      if len(data) > remaining:
+        resp.close()
+        raise RangeNotSupported
+      remaining -= len(data)
+      yield data
+
+  def _HashFile(self, path, start=0, length=None):
+    hash_obj = hashlib.sha256()
+    with open(path, 'rb') as fh:
+      fh.seek(start)
+      remaining = length
+      while remaining is None or remaining > 0:
+        data = fh.read(self._BUF_SIZE if remaining is None else min(self._BUF_SIZE, remaining))
+        if not data:
+          break
+        hash_obj.update(data)
+        if remaining is not None:
+          remaining -= len(data)
+    return hash_obj.hexdigest()
+
+  def _FetchImageDelta(self, image, partial_path):
+    # Assemble the new image from blocks we already have in older local
+    # images, fetching only what's missing. Returns False if the result
+    # doesn't verify, so the caller can fall back to a full download.
+    local_paths = [
+        os.path.join(self._image_dir, filename)
+        for filename in sorted(os.listdir(self._image_dir), reverse=True)
+        if self._FILE_REGEX.match(filename)
+    ]
+    if not local_paths:
+      return False
+
+    index = self._GetBlockIndex(image)
+    found = delta.FindLocalBlocks(index, local_paths)
+    if not found:
+      return False
+    print('Reusing %d/%d blocks from local images' % (len(found), len(index['blocks'])), flush=True)
+
+    url = '%s/%d.iso' % (self._base_url, image['timestamp'])
+    local_fhs = {}
+    try:
+      with open(partial_path, 'wb') as fh:
+        fh.truncate(index['size'])
+        for num, (path, offset) in sorted(found.items()):
+          if path not in local_fhs:
+            local_fhs[path] = open(path, 'rb')
+          local_fh = local_fhs[path]
+          local_fh.seek(offset)
+          fh.seek(num * index['block_size'])
+          fh.write(local_fh.read(index['block_size']))
+
+        for start, end in delta.MissingRanges(index, found):
+          fh.seek(start)
+          for data in self._FetchRange(self._session, url, start, end, index['size']):
+            fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    except RangeNotSupported:
+      return False
+    finally:
+      for local_fh in local_fhs.values():
+        local_fh.close()
+
+    if self._HashFile(partial_path) != image['hash']:
+      print('Delta assembly failed verification; fetching full image', flush=True)
+      return False
+    return True
+
+  def _FetchImageStream(self, image, partial_path, journal_path, journal):
+    hash_obj = hashlib.sha256()
+    offset = self._ResumeOffset(journal, partial_path, hash_obj)
+    if not offset:
+      hash_obj = hashlib.sha256()
+
+    url = '%s/%d.iso' % (self._base_url, image['timestamp'])
+    headers = {}
+    if offset:
+      print('Resuming:', url, 'at', offset, flush=True)
+      headers['Range'] = 'bytes=%d-' % offset
+    else:
+      print('Fetching:', url, flush=True)
+    resp = self._session.get(url, headers=headers, stream=True)
+    resp.raise_for_status()
+
+    match = self._CONTENT_RANGE_REGEX.match(resp.headers.get('Content-Range', ''))
+    if offset and (resp.status_code != 206 or
+                   not match or
+                   int(match.group('start')) != offset or
+                   int(match.group('end')) != image['size'] - 1 or
+                   int(match.group('size')) != image['size']):
+      # Server ignored or mangled our range request; start over
+      offset = 0
+      hash_obj = hashlib.sha256()
+
+    with open(partial_path, 'r+b' if offset else 'wb') as fh:
+      fh.seek(offset)
+      fh.truncate()
+      journaled = offset
+      for data in resp.iter_content(self._BUF_SIZE):
+        hash_obj.update(data)
+        fh.write(data)
+        offset += len(data)
+        if offset - journaled >= self._JOURNAL_INTERVAL:
+          fh.flush()
+          os.fsync(fh.fileno())
+          self._WriteJournal(image, journal_path, offset=offset, prefix_hash=hash_obj.hexdigest())
+          journaled = offset
+      fh.flush()
+      os.fsync(fh.fileno())
+
+    if hash_obj.hexdigest() != image['hash']:
+      raise InvalidHash
+
+  def _FetchChunkFrom(self, session, url, fd, image, num, **kwargs):
+    start = num * image['chunk_size']
+    end = min(start + image['chunk_size'], image['size']) - 1
+    hash_obj = hashlib.sha256()
+    offset = start
+    for data in self._FetchRange(session, url, start, end, image['size'], **kwargs):
+      hash_obj.update(data)
+      os.pwrite(fd, data, offset)
+      offset += len(data)
+    return offset == end + 1 and hash_obj.hexdigest() == image['chunks'][num]
+
+  def _FetchChunk(self, session, url, peer_urls, fd, image, num):
+    # Try peers first, spreading chunks across them. We don't authenticate
+    # peers, but _FetchRange never writes outside the chunk and the chunk is
+    # verified, so a bad one just costs us a chunk.
+    for i in range(len(peer_urls)):
+      peer_url = peer_urls[(num + i) % len(peer_urls)]
+      try:
+        if self._FetchChunkFrom(session, '%s/%d.iso' % (peer_url, image['timestamp']), fd, image, num, verify=False):
+          return
+      except (requests.RequestException, RangeNotSupported):
+        pass
+      print('Chunk %d from peer %s failed; trying next source' % (num, peer_url), flush=True)
+
+    for _ in range(self._MAX_CHUNK_ATTEMPTS):
+      if self._FetchChunkFrom(session, url, fd, image, num):
+        return
+      print('Chunk %d failed verification; re-fetching' % num, flush=True)
+    raise InvalidHash
+
+  def _FetchImageChunked(self, image, partial_path, journal_path, journal):
+    # Fetch fixed-size chunks over several connections into a preallocated
+    # file, verifying each against the signed manifest as it arrives. The
+    # journal records verified chunks so an interrupted download resumes.
+    url = '%s/%d.iso' % (self._base_url, image['timestamp'])
+    done = set()
+    if journal and 'chunks_done' in journal and os.path.exists(partial_path):
+      for num in journal['chunks_done']:
+        start = num * image['chunk_size']
+        if self._HashFile(partial_path, start, image['chunk_size']) == image['chunks'][num]:
+          done.add(num)
+    else:
+      with open(partial_path, 'wb') as fh:
+        fh.truncate(image['size'])
+
+    peer_urls = []
+    if self._peer_finder:
+      peer_urls = self._peer_finder.Find(image['hash'])
+      if peer_urls:
+        print('Found peers:', ' '.join(peer_urls), flush=True)
+
+    pending = queue.Queue()
+    for num in range(len(image['chunks'])):
+      if num not in done:
+        pending.put(num)
+    if done:
+      print('Resuming:', url, 'with %d/%d chunks' % (len(done), len(image['chunks'])), flush=True)
+    else:
+      print('Fetching:', url, 'over %d connections' % self._num_workers, flush=True)
+
+    lock = threading.Lock()
+    errors = []
+    fd = os.open(partial_path, os.O_WRONLY)
+
+    def Worker():
+      session = self._NewSession()
+      while not errors:
+        try:
+          num = pending.get_nowait()
+        except queue.Empty:
+          return
+        try:
+          self._FetchChunk(session, url, peer_urls, fd, image, num)
+          os.fsync(fd)
+        except Exception as e:
+          errors.append(e)
+          return
+        with lock:
+          done.add(num)
+          self._WriteJournal(image, journal_path, chunks_done=sorted(done))
+
+    try:
+      workers = [threading.Thread(target=Worker) for _ in range(self._num_workers)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+    finally:
+      os.close(fd)
+
+    if errors:
+      raise errors[0]
+
+    if self._HashFile(partial_path) != image['hash']:
+      raise InvalidHash
+
   def _FetchImage(self, image):
     filename = '%d.iso' % (image['timestamp'])
     path = os.path.join(self._image_dir, filename)
@@ -131,22 +500,32 @@ class Fetcher(object):
     if os.path.exists(path):
       return
 
-    url = '%s/%s' % (self._base_url, filename)
-    print('Fetching:', url, flush=True)
-    resp = self._session.get(url, stream=True)
+    partial_path = path + '.partial'
+    journal_path = path + '.journal'
+    journal = self._ReadJournal(image, journal_path)
 
-    hash_obj = hashlib.sha256()
-    with tempfile.NamedTemporaryFile(dir=self._image_dir, delete=False) as fh:
-      try:
-        for data in resp.iter_content(self._BUF_SIZE):
-          hash_obj.update(data)
-          fh.write(data)
-        if hash_obj.hexdigest() != image['hash']:
-          raise InvalidHash
-        os.rename(fh.name, path)
-      except:
-        os.unlink(fh.name)
-        raise
+    try:
+      fetched = (
+          not journal and
+          'block_index_hash' in image and
+          self._FetchImageDelta(image, partial_path))
+      if not fetched and 'chunks' in image and self._num_workers > 1:
+        self._FetchImageChunked(image, partial_path, journal_path, journal)
+      elif not fetched:
+        self._FetchImageStream(image, partial_path, journal_path, journal)
+    except InvalidHash:
+      self._Unlink(partial_path)
+      self._Unlink(journal_path)
+      raise
+
+    os.rename(partial_path, path)
+    self._Unlink(journal_path)
+
+  def _Unlink(self, path):
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
 
   def _SetCurrent(self, image):
     filename = '%d.iso' % (image['timestamp'])
@@ -166,25 +545,34 @@ class Fetcher(object):
     os.symlink(filename, temp_path)
     os.rename(temp_path, current_path)
 
-  def Fetch(self, force_timestamp=None):
-    manifest = self._GetManifest()
-    if force_timestamp:
-      image = self._FindImage(manifest, force_timestamp)
-    else:
-      image = self._ChooseImage(manifest)
-    self._FetchImage(image)
-    self._SetCurrent(image)
+  def Fetch(self, force_timestamp=None, pushed_manifest=None, pushed_etag=None):
+    with self._fetch_lock:
+      manifest = self._GetManifest(pushed_manifest, pushed_etag)
+      if force_timestamp:
+        image = self._FindImage(manifest, force_timestamp)
+      else:
+        image = self._ChooseImage(manifest)
+      self._FetchImage(image)
+      self._SetCurrent(image)
 
   def DeleteOldImages(self, max_images=5, skip=None):
+    with self._fetch_lock:
+      self._DeleteOldImages(max_images, skip)
+
+  def _DeleteOldImages(self, max_images, skip):
     if not max_images:
       return
     skip = skip or set()
     images = []
+    partials = []
     for filename in os.listdir(self._image_dir):
       match = self._FILE_REGEX.match(filename)
-      if not match:
+      if match:
+        images.append((int(match.group('timestamp')), filename))
         continue
-      images.append((int(match.group('timestamp')), filename))
+      match = self._PARTIAL_REGEX.match(filename)
+      if match:
+        partials.append((int(match.group('timestamp')), filename))
     images.sort(reverse=True)
     for timestamp, filename in images[max_images:]:
       if filename in skip:
@@ -192,3 +580,15 @@ class Fetcher(object):
       print('Deleting old image:', filename, flush=True)
       path = os.path.join(self._image_dir, filename)
       os.unlink(path)
+
+    # Interrupted downloads of images that have since been superseded will
+    # never be resumed.
+    if len(images) < max_images:
+      return
+    oldest_kept = images[max_images - 1][0]
+    for timestamp, filename in partials:
+      if timestamp >= oldest_kept:
+        continue
+      print('Deleting stale partial download:', filename, flush=True)
+      path = os.path.join(self._image_dir, filename)
+      os.unlink(path)
@@ -0,0 +1,178 @@
+import http.server
+import json
+import os
+import re
+import socket
+import socketserver
+import ssl
+import threading
+import time
+
+
+# Hosts on the same LAN share images with each other. Discovery is a
+# multicast "who has <hash>?" query answered by peers that hold a verified
+# copy; the image itself is then fetched from the peer over HTTPS. Clients
+# must present a fleet certificate, but we don't authenticate the peer:
+# every chunk is checked against the signed manifest anyway.
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+class _ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+
+  _PATH_REGEX = re.compile('^/image/(?P<filename>\d+\.iso)$')
+  _RANGE_REGEX = re.compile('^bytes=(?P<start>\d+)-(?P<end>\d*)$')
+  _BUF_SIZE = 2 ** 16
+
+  def do_GET(self):
+    match = self._PATH_REGEX.match(self.path)
+    if not match:
+      self.send_error(404)
+      return
+
+    path = os.path.join(self.server.image_dir, match.group('filename'))
+    try:
+      fh = open(path, 'rb')
+    except FileNotFoundError:
+      self.send_error(404)
+      return
+
+    with fh:
+      size = os.fstat(fh.fileno()).st_size
+      start, end = 0, size - 1
+      match = self._RANGE_REGEX.match(self.headers.get('Range', ''))
+      if match:
+        start = int(match.group('start'))
+        if match.group('end'):
+          end = min(int(match.group('end')), end)
+        if start > end:
+          self.send_error(416)
+          return
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+      else:
+        self.send_response(200)
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(end - start + 1))
+      self.end_headers()
+
+      print('Serving to peer:', self.client_address[0], path, start, end, flush=True)
+      fh.seek(start)
+      remaining = end - start + 1
+      while remaining > 0:
+        data = fh.read(min(self._BUF_SIZE, remaining))
+        if not data:
+          break
+        self.wfile.write(data)
+        remaining -= len(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class PeerServer(object):
+
+  def __init__(self, image_dir, port, group, discovery_port, interface, https_ca_cert, https_client_cert, https_client_key):
+    self._image_dir = image_dir
+    self._port = port
+    self._group = group
+    self._discovery_port = discovery_port
+    self._interface = interface
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=https_ca_cert)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_cert_chain(https_client_cert, https_client_key)
+
+    self._httpd = _ThreadingHTTPServer((interface, port), _ImageRequestHandler)
+    self._httpd.image_dir = image_dir
+    self._httpd.socket = context.wrap_socket(self._httpd.socket, server_side=True)
+
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind(('', discovery_port))
+    self._sock.setsockopt(
+        socket.IPPROTO_IP,
+        socket.IP_ADD_MEMBERSHIP,
+        socket.inet_aton(group) + socket.inet_aton(interface))
+
+  def _HaveImage(self, image_hash):
+    # Only answer for images that completed verification; the manifest was
+    # verified before it was written.
+    try:
+      with open(os.path.join(self._image_dir, 'manifest.json'), 'r') as fh:
+        manifest = json.load(fh)
+    except (FileNotFoundError, ValueError):
+      return False
+    for image in manifest['images']:
+      if image.get('hash') != image_hash:
+        continue
+      path = os.path.join(self._image_dir, '%d.iso' % image['timestamp'])
+      return os.path.exists(path)
+    return False
+
+  def _Respond(self):
+    while True:
+      data, addr = self._sock.recvfrom(2 ** 12)
+      try:
+        parsed = json.loads(data.decode('utf8'))
+      except ValueError:
+        continue
+      if parsed.get('type') != 'who_has':
+        continue
+      if not self._HaveImage(parsed.get('hash')):
+        continue
+      self._sock.sendto(json.dumps({
+        'type': 'have',
+        'hash': parsed['hash'],
+        'port': self._port,
+      }).encode('utf8'), addr)
+
+  def Start(self):
+    for target in (self._httpd.serve_forever, self._Respond):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+
+
+class PeerFinder(object):
+
+  def __init__(self, group, discovery_port, interface, timeout=0.5):
+    self._group = group
+    self._discovery_port = discovery_port
+    self._interface = interface
+    self._timeout = timeout
+
+  def Find(self, image_hash):
+    # Returns base URLs of peers holding a verified copy of the image.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self._interface))
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+      sock.sendto(json.dumps({
+        'type': 'who_has',
+        'hash': image_hash,
+      }).encode('utf8'), (self._group, self._discovery_port))
+
+      peers = set()
+      deadline = time.time() + self._timeout
+      while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        sock.settimeout(remaining)
+        try:
+          data, addr = sock.recvfrom(2 ** 12)
+        except socket.timeout:
+          break
+        try:
+          parsed = json.loads(data.decode('utf8'))
+        except ValueError:
+          continue
+        if parsed.get('type') != 'have' or parsed.get('hash') != image_hash:
+          continue
+        peers.add('https://%s:%d/image' % (addr[0], parsed['port']))
+      return sorted(peers)
+    finally:
+      sock.close()
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+import os
+import random
+import tempfile
+import unittest
+
+import delta
+
+
+def RandomBytes(length, seed):
+  return random.Random(seed).randbytes(length)
+
+
+def Index(data):
+  builder = delta.BlockIndexBuilder()
+  for i in range(0, len(data), delta.BLOCK_SIZE):
+    builder.Update(data[i:i + delta.BLOCK_SIZE])
+  return builder.Index()
+
+
+class WeakHashTest(unittest.TestCase):
+
+  def _RsyncChecksum(self, data):
+    # The textbook per-byte definition.
+    a = sum(data) % 65521
+    b = sum((len(data) - i) * x for i, x in enumerate(data)) % 65521
+    return (b << 16) | a
+
+  def testMatchesRsync(self):
+    data = RandomBytes(delta.BLOCK_SIZE, 1)
+    self.assertEqual(delta.WeakHash(data), self._RsyncChecksum(data))
+
+  def testZeros(self):
+    self.assertEqual(delta.WeakHash(b'\x00' * delta.BLOCK_SIZE), 0)
+
+
+class BlockIndexBuilderTest(unittest.TestCase):
+
+  def testSkipsTail(self):
+    data = RandomBytes(3 * delta.BLOCK_SIZE + 100, 2)
+    index = Index(data)
+    self.assertEqual(index['size'], len(data))
+    self.assertEqual(index['block_size'], delta.BLOCK_SIZE)
+    self.assertEqual(index['sector_size'], delta.SECTOR_SIZE)
+    self.assertEqual(len(index['blocks']), 3)
+    for num, (weak, strong) in enumerate(index['blocks']):
+      block = data[num * delta.BLOCK_SIZE:(num + 1) * delta.BLOCK_SIZE]
+      self.assertEqual(weak, delta.WeakHash(block))
+      self.assertEqual(strong, delta.StrongHash(block))
+
+
+class FindLocalBlocksTest(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._data = RandomBytes(4 * delta.BLOCK_SIZE + 100, 3)
+    self._index = Index(self._data)
+
+  def tearDown(self):
+    for file_name in os.listdir(self._dir):
+      os.unlink(os.path.join(self._dir, file_name))
+    os.rmdir(self._dir)
+
+  def _Write(self, file_name, data):
+    path = os.path.join(self._dir, file_name)
+    with open(path, 'wb') as fh:
+      fh.write(data)
+    return path
+
+  def _Block(self, num):
+    return self._data[num * delta.BLOCK_SIZE:(num + 1) * delta.BLOCK_SIZE]
+
+  def testIdentical(self):
+    path = self._Write('old.iso', self._data)
+    found = delta.FindLocalBlocks(self._index, [path])
+    self.assertEqual(found, {
+      num: (path, num * delta.BLOCK_SIZE)
+      for num in range(4)
+    })
+
+  def testSectorShifted(self):
+    # Files move by whole sectors between images, not whole blocks.
+    shift = 3 * delta.SECTOR_SIZE
+    old = RandomBytes(shift, 4) + self._Block(1) + self._Block(2) + RandomBytes(delta.BLOCK_SIZE, 5)
+    path = self._Write('old.iso', old)
+    found = delta.FindLocalBlocks(self._index, [path])
+    self.assertEqual(found, {
+      1: (path, shift),
+      2: (path, shift + delta.BLOCK_SIZE),
+    })
+
+  def testAcrossFiles(self):
+    first = self._Write('1.iso', self._Block(0) + RandomBytes(delta.BLOCK_SIZE, 6))
+    second = self._Write('2.iso', RandomBytes(delta.SECTOR_SIZE, 7) + self._Block(3))
+    found = delta.FindLocalBlocks(self._index, [first, second])
+    self.assertEqual(found, {
+      0: (first, 0),
+      3: (second, delta.SECTOR_SIZE),
+    })
+
+  def testWeakCollisionNeedsStrongMatch(self):
+    # Every weak hash matches, but none of the strong ones do.
+    index = dict(self._index, blocks=[
+      [weak, '0' * 64]
+      for weak, strong in self._index['blocks']
+    ])
+    path = self._Write('old.iso', self._data)
+    self.assertEqual(delta.FindLocalBlocks(index, [path]), {})
+
+  def testShortFile(self):
+    path = self._Write('short.iso', self._Block(0)[:delta.BLOCK_SIZE - 1])
+    self.assertEqual(delta.FindLocalBlocks(self._index, [path]), {})
+
+
+class MissingRangesTest(unittest.TestCase):
+
+  def _Index(self, blocks, tail):
+    return {
+      'block_size': delta.BLOCK_SIZE,
+      'sector_size': delta.SECTOR_SIZE,
+      'size': blocks * delta.BLOCK_SIZE + tail,
+      'blocks': [[0, '']] * blocks,
+    }
+
+  def _Ranges(self, index, found):
+    return list(delta.MissingRanges(index, {num: None for num in found}))
+
+  def testNothingFound(self):
+    index = self._Index(3, 100)
+    self.assertEqual(self._Ranges(index, []), [(0, index['size'] - 1)])
+
+  def testEverythingFound(self):
+    # Only the unindexed tail is left.
+    index = self._Index(3, 100)
+    self.assertEqual(self._Ranges(index, [0, 1, 2]), [(3 * delta.BLOCK_SIZE, index['size'] - 1)])
+
+  def testEverythingFoundNoTail(self):
+    self.assertEqual(self._Ranges(self._Index(3, 0), [0, 1, 2]), [])
+
+  def testGapsMerge(self):
+    index = self._Index(6, 0)
+    self.assertEqual(self._Ranges(index, [0, 3]), [
+      (delta.BLOCK_SIZE, 3 * delta.BLOCK_SIZE - 1),
+      (4 * delta.BLOCK_SIZE, index['size'] - 1),
+    ])
+
+  def testGapRunsIntoTail(self):
+    index = self._Index(3, 100)
+    self.assertEqual(self._Ranges(index, [0]), [(delta.BLOCK_SIZE, index['size'] - 1)])
+
+
+if __name__ == '__main__':
+  unittest.main()
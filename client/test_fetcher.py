@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+import hashlib
+import os
+import requests
+import tempfile
+import unittest
+
+import fetcher
+
+
+class FakeResponse(object):
+
+  def __init__(self, status_code, content_range, body):
+    self.status_code = status_code
+    self.headers = {}
+    if content_range:
+      self.headers['Content-Range'] = content_range
+    self._body = body
+    self.closed = False
+
+  def raise_for_status(self):
+    if self.status_code >= 400:
+      raise requests.HTTPError(self.status_code)
+
+  def iter_content(self, chunk_size):
+    for i in range(0, len(self._body), chunk_size):
+      yield self._body[i:i + chunk_size]
+
+  def close(self):
+    self.closed = True
+
+
+class FakeSession(object):
+
+  def __init__(self, responses):
+    # A response for every URL, or a dict of them by URL.
+    self._responses = responses
+    self.headers = []
+
+  def get(self, url, headers=None, stream=False, **kwargs):
+    self.headers.append(headers)
+    if isinstance(self._responses, dict):
+      return self._responses[url]
+    return self._responses
+
+
+def NewFetcher():
+  # Only the range handling is under test; skip CA and session setup.
+  return fetcher.Fetcher.__new__(fetcher.Fetcher)
+
+
+class FetchRangeTest(unittest.TestCase):
+
+  def _Fetch(self, status_code, content_range, body, start=10, end=19, size=100):
+    session = FakeSession(FakeResponse(status_code, content_range, body))
+    data = b''.join(NewFetcher()._FetchRange(session, 'http://x/1.iso', start, end, size))
+    self.assertEqual(session.headers, [{'Range': 'bytes=%d-%d' % (start, end)}])
+    return data
+
+  def testExactRange(self):
+    self.assertEqual(self._Fetch(206, 'bytes 10-19/100', b'0123456789'), b'0123456789')
+
+  def testWholeFileIgnoresRange(self):
+    with self.assertRaises(fetcher.RangeNotSupported):
+      self._Fetch(200, None, b'x' * 100)
+
+  def testWrongStart(self):
+    with self.assertRaises(fetcher.RangeNotSupported):
+      self._Fetch(206, 'bytes 0-19/100', b'x' * 20)
+
+  def testWrongEnd(self):
+    # e.g. a proxy that ignored the requested end.
+    with self.assertRaises(fetcher.RangeNotSupported):
+      self._Fetch(206, 'bytes 10-99/100', b'x' * 90)
+
+  def testWrongSize(self):
+    with self.assertRaises(fetcher.RangeNotSupported):
+      self._Fetch(206, 'bytes 10-19/200', b'x' * 10)
+
+  def testUnknownSize(self):
+    with self.assertRaises(fetcher.RangeNotSupported):
+      self._Fetch(206, 'bytes 10-19/*', b'x' * 10)
+
+  def testHTTPError(self):
+    with self.assertRaises(requests.HTTPError):
+      self._Fetch(404, None, b'')
+
+  def testBodyLongerThanRange(self):
+    with self.assertRaises(fetcher.RangeNotSupported):
+      self._Fetch(206, 'bytes 10-19/100', b'x' * 11)
+
+
+class FetchChunkTest(unittest.TestCase):
+
+  _CHUNK_SIZE = 8
+
+  def setUp(self):
+    self._data = bytes(range(20))
+    self._image = {
+      'timestamp': 1,
+      'size': len(self._data),
+      'chunk_size': self._CHUNK_SIZE,
+      'chunks': [
+        hashlib.sha256(self._data[i:i + self._CHUNK_SIZE]).hexdigest()
+        for i in range(0, len(self._data), self._CHUNK_SIZE)
+      ],
+    }
+    fd, self._path = tempfile.mkstemp()
+    # Neighbouring chunks already verified and in place.
+    os.write(fd, b'\xff' * len(self._data))
+    self._fd = fd
+
+  def tearDown(self):
+    os.close(self._fd)
+    os.unlink(self._path)
+
+  def _Contents(self):
+    with open(self._path, 'rb') as fh:
+      return fh.read()
+
+  def _Response(self, start, end, body=None):
+    if body is None:
+      body = self._data[start:end + 1]
+    return FakeResponse(206, 'bytes %d-%d/%d' % (start, end, len(self._data)), body)
+
+  def testWritesChunk(self):
+    session = FakeSession(self._Response(8, 15))
+    self.assertTrue(NewFetcher()._FetchChunkFrom(session, 'http://x/1.iso', self._fd, self._image, 1))
+    self.assertEqual(self._Contents(), b'\xff' * 8 + self._data[8:16] + b'\xff' * 4)
+
+  def testLastChunkIsShort(self):
+    session = FakeSession(self._Response(16, 19))
+    self.assertTrue(NewFetcher()._FetchChunkFrom(session, 'http://x/1.iso', self._fd, self._image, 2))
+    self.assertEqual(self._Contents()[16:], self._data[16:])
+
+  def testCorruptChunkFailsVerification(self):
+    session = FakeSession(self._Response(8, 15, b'\x00' * 8))
+    self.assertFalse(NewFetcher()._FetchChunkFrom(session, 'http://x/1.iso', self._fd, self._image, 1))
+
+  def testShortChunkFailsVerification(self):
+    session = FakeSession(self._Response(8, 15, self._data[8:12]))
+    self.assertFalse(NewFetcher()._FetchChunkFrom(session, 'http://x/1.iso', self._fd, self._image, 1))
+
+  def testOverlongPeerDoesNotTouchNeighbours(self):
+    # A peer that sends past the chunk is skipped for the server, and the
+    # neighbouring chunks stay as they were.
+    session = FakeSession({
+      'http://peer/1.iso': self._Response(8, 15, self._data[8:] + b'\x00' * 8),
+      'http://server/1.iso': self._Response(8, 15),
+    })
+    NewFetcher()._FetchChunk(session, 'http://server/1.iso', ['http://peer'], self._fd, self._image, 1)
+    self.assertEqual(self._Contents(), b'\xff' * 8 + self._data[8:16] + b'\xff' * 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import os
+import struct
+import tempfile
+import unittest
+
+import iso9660
+
+
+def Descriptor(descriptor_type, volume_id='', system_id=''):
+  data = bytearray(iso9660._SECTOR_SIZE)
+  data[0] = descriptor_type
+  data[1:6] = iso9660._MAGIC
+  data[6] = 1
+  data[8:40] = system_id.ljust(32).encode('ascii')
+  data[40:72] = volume_id.ljust(32).encode('ascii')
+  struct.pack_into('<L', data, 80, 1234)
+  struct.pack_into('<H', data, 128, iso9660._SECTOR_SIZE)
+  return bytes(data)
+
+
+def Image(*descriptors):
+  return b'\x00' * (iso9660._FIRST_DESCRIPTOR * iso9660._SECTOR_SIZE) + b''.join(descriptors)
+
+
+class GetPrimaryVolumeDescriptorTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self._path = tempfile.mkstemp()
+    os.close(fd)
+
+  def tearDown(self):
+    os.unlink(self._path)
+    iso9660._cache.pop(self._path, None)
+
+  def _Write(self, data):
+    with open(self._path, 'wb') as fh:
+      fh.write(data)
+
+  def testPrimary(self):
+    self._Write(Image(
+      Descriptor(iso9660._TYPE_PRIMARY, volume_id='1500000000', system_id='LINUX'),
+      Descriptor(iso9660._TYPE_TERMINATOR)))
+    pvd = iso9660.GetPrimaryVolumeDescriptor(self._path)
+    self.assertEqual(pvd['volume_id'], '1500000000')
+    self.assertEqual(pvd['system_id'], 'LINUX')
+    self.assertEqual(pvd['volume_space_size'], 1234)
+    self.assertEqual(pvd['logical_block_size'], iso9660._SECTOR_SIZE)
+    self.assertEqual(iso9660.GetVolumeID(self._path), '1500000000')
+
+  def testSkipsOtherDescriptors(self):
+    # e.g. an El Torito boot record ahead of the primary.
+    self._Write(Image(
+      Descriptor(0),
+      Descriptor(iso9660._TYPE_PRIMARY, volume_id='boot'),
+      Descriptor(iso9660._TYPE_TERMINATOR)))
+    self.assertEqual(iso9660.GetVolumeID(self._path), 'boot')
+
+  def testTerminatorBeforePrimary(self):
+    self._Write(Image(
+      Descriptor(iso9660._TYPE_TERMINATOR),
+      Descriptor(iso9660._TYPE_PRIMARY, volume_id='late')))
+    with self.assertRaises(iso9660.NotISO9660):
+      iso9660.GetVolumeID(self._path)
+
+  def testNoMagic(self):
+    self._Write(Image(b'\x01' + b'XXXXX' + Descriptor(iso9660._TYPE_PRIMARY)[6:]))
+    with self.assertRaises(iso9660.NotISO9660):
+      iso9660.GetVolumeID(self._path)
+
+  def testShortFile(self):
+    self._Write(b'\x00' * 100)
+    with self.assertRaises(iso9660.NotISO9660):
+      iso9660.GetVolumeID(self._path)
+
+  def testReplacedFileIsReread(self):
+    self._Write(Image(Descriptor(iso9660._TYPE_PRIMARY, volume_id='old')))
+    self.assertEqual(iso9660.GetVolumeID(self._path), 'old')
+    self._Write(Image(Descriptor(iso9660._TYPE_PRIMARY, volume_id='newer')))
+    # Same size and inode; only the mtime tells them apart.
+    stat = os.stat(self._path)
+    os.utime(self._path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    self.assertEqual(iso9660.GetVolumeID(self._path), 'newer')
+
+
+if __name__ == '__main__':
+  unittest.main()
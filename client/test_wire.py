@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import unittest
+
+import wire
+
+
+class ForProtocolsTest(unittest.TestCase):
+
+  def testNoneIsJSON(self):
+    self.assertEqual(wire.Codec.ForProtocols(None).protocol, wire.Codec.JSON)
+
+  def testUnknownIsJSON(self):
+    self.assertEqual(wire.Codec.ForProtocols(['foo']).protocol, wire.Codec.JSON)
+
+  def testBytes(self):
+    # ws4py hands over the handshake's protocols as bytes.
+    codec = wire.Codec.ForProtocols([wire.Codec.JSON.encode('ascii')])
+    self.assertEqual(codec.protocol, wire.Codec.JSON)
+
+  @unittest.skipUnless(wire.msgpack, 'needs msgpack')
+  def testPrefersOurOrder(self):
+    codec = wire.Codec.ForProtocols([wire.Codec.JSON, wire.Codec.MSGPACK, wire.Codec.MSGPACK_DEFLATE])
+    self.assertEqual(codec.protocol, wire.Codec.MSGPACK_DEFLATE)
+
+
+class CodecTest(unittest.TestCase):
+
+  _MSG = {
+    'type': 'report',
+    'data': {
+      'hostname': 'host-00',
+      'uptime_seconds': 100,
+      'status': ['a', 'b'],
+    },
+  }
+
+  def _RoundTrip(self, protocol, msgs):
+    sender = wire.Codec(protocol)
+    receiver = wire.Codec(protocol)
+    for msg in msgs:
+      self.assertEqual(receiver.Decode(sender.Encode(msg)), msg)
+
+  def testJSON(self):
+    codec = wire.Codec(wire.Codec.JSON)
+    self.assertFalse(codec.binary)
+    self.assertIsInstance(codec.Encode(self._MSG), str)
+    self._RoundTrip(wire.Codec.JSON, [self._MSG])
+
+  def testJSONBytes(self):
+    codec = wire.Codec(wire.Codec.JSON)
+    self.assertEqual(codec.Decode(codec.Encode(self._MSG).encode('utf8')), self._MSG)
+
+  @unittest.skipUnless(wire.msgpack, 'needs msgpack')
+  def testMsgpack(self):
+    self.assertTrue(wire.Codec(wire.Codec.MSGPACK).binary)
+    self._RoundTrip(wire.Codec.MSGPACK, [self._MSG, self._MSG])
+
+  @unittest.skipUnless(wire.msgpack, 'needs msgpack')
+  def testDeflateStream(self):
+    # Each message is decodable as it arrives, in order, from one stream.
+    msgs = [dict(self._MSG, seq=i) for i in range(10)]
+    self._RoundTrip(wire.Codec.MSGPACK_DEFLATE, msgs)
+
+  @unittest.skipUnless(wire.msgpack, 'needs msgpack')
+  def testDeflateContextTakeover(self):
+    # Repeats compress against what the stream has already seen.
+    codec = wire.Codec(wire.Codec.MSGPACK_DEFLATE)
+    first = codec.Encode(self._MSG)
+    second = codec.Encode(self._MSG)
+    self.assertLess(len(second), len(first))
+
+  @unittest.skipUnless(wire.msgpack, 'needs msgpack')
+  def testSerializeOnceFramePerConnection(self):
+    # A broadcast is serialized once and framed for each connection.
+    data = wire.Codec.Serialize(wire.Codec.MSGPACK_DEFLATE, self._MSG)
+    for _ in range(3):
+      sender = wire.Codec(wire.Codec.MSGPACK_DEFLATE)
+      receiver = wire.Codec(wire.Codec.MSGPACK_DEFLATE)
+      self.assertEqual(receiver.Decode(sender.Frame(data)), self._MSG)
+
+  def testFrameIsIdentityWithoutDeflate(self):
+    data = wire.Codec.Serialize(wire.Codec.JSON, self._MSG)
+    self.assertEqual(wire.Codec(wire.Codec.JSON).Frame(data), data)
+
+
+if __name__ == '__main__':
+  unittest.main()
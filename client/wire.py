@@ -0,0 +1,78 @@
+import json
+import zlib
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+
+# Encoding for slave WebSocket messages, chosen by subprotocol.
+# iconograph-slave is plain JSON text, and what old clients and servers speak.
+# The -msgpack variants send MessagePack binary frames. The -deflate variant
+# also runs them through one raw deflate stream per direction for the life of
+# the connection, flushed after each message: permessage-deflate with context
+# takeover, done here because ws4py doesn't implement RFC 7692.
+
+
+class Codec(object):
+
+  JSON = 'iconograph-slave'
+  MSGPACK = 'iconograph-slave-msgpack'
+  MSGPACK_DEFLATE = 'iconograph-slave-msgpack-deflate'
+
+  _DEFLATE_TRAILER = b'\x00\x00\xff\xff'
+
+  @classmethod
+  def Protocols(cls):
+    # Most preferred first.
+    if msgpack:
+      return [cls.MSGPACK_DEFLATE, cls.MSGPACK, cls.JSON]
+    return [cls.JSON]
+
+  @classmethod
+  def ForProtocols(cls, protocols):
+    protocols = [
+        x.decode('ascii') if isinstance(x, bytes) else x
+        for x in (protocols or [])
+    ]
+    for protocol in cls.Protocols():
+      if protocol in protocols:
+        return cls(protocol)
+    return cls(cls.JSON)
+
+  def __init__(self, protocol):
+    self.protocol = protocol
+    self.binary = protocol != self.JSON
+    self._compress = None
+    self._decompress = None
+    if protocol == self.MSGPACK_DEFLATE:
+      self._compress = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+      self._decompress = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+  @classmethod
+  def Serialize(cls, protocol, msg):
+    # The stateless half of Encode(), so a broadcast can be serialized once
+    # per protocol and shared between connections.
+    if protocol == cls.JSON:
+      return json.dumps(msg)
+    return msgpack.packb(msg, use_bin_type=True)
+
+  def Frame(self, data):
+    # The per-connection half: the deflate context belongs to one stream.
+    if self._compress:
+      data = self._compress.compress(data) + self._compress.flush(zlib.Z_SYNC_FLUSH)
+      data = data[:-len(self._DEFLATE_TRAILER)]
+    return data
+
+  def Encode(self, msg):
+    return self.Frame(self.Serialize(self.protocol, msg))
+
+  def Decode(self, data):
+    if not self.binary:
+      if isinstance(data, bytes):
+        data = data.decode('utf8')
+      return json.loads(data)
+    if self._decompress:
+      data = self._decompress.decompress(data + self._DEFLATE_TRAILER)
+    return msgpack.unpackb(data, raw=False)
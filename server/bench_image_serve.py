@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import http.client
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+
+parser = argparse.ArgumentParser(description='iconograph bench_image_serve')
+parser.add_argument(
+    '--ca-cert',
+    dest='ca_cert',
+    action='store')
+parser.add_argument(
+    '--client-cert',
+    dest='client_cert',
+    action='store')
+parser.add_argument(
+    '--client-key',
+    dest='client_key',
+    action='store')
+parser.add_argument(
+    '--connections',
+    dest='connections',
+    type=int,
+    action='store',
+    default=4)
+parser.add_argument(
+    '--image-size-mb',
+    dest='image_size_mb',
+    type=int,
+    action='store',
+    default=512)
+parser.add_argument(
+    '--requests',
+    dest='requests',
+    type=int,
+    action='store',
+    default=16)
+parser.add_argument(
+    '--server-cert',
+    dest='server_cert',
+    action='store')
+parser.add_argument(
+    '--server-key',
+    dest='server_key',
+    action='store')
+FLAGS = parser.parse_args()
+
+
+class Benchmark(object):
+  # Serves a single image over loopback from a real server.py process and
+  # reports throughput and bytes per second of server CPU time.
+
+  _BLOCK_SIZE = 2 ** 20
+  _IMAGE_TYPE = 'bench'
+  _IMAGE_NAME = 'bench.iso'
+
+  def __init__(self, image_size_mb, connections, requests, tls_args):
+    self._image_size = image_size_mb * 2 ** 20
+    self._connections = connections
+    self._requests = requests
+    self._tls_args = tls_args
+
+  def Run(self):
+    image_path = tempfile.mkdtemp()
+    try:
+      self._WriteImage(image_path)
+      if self._tls_args:
+        # Python's ssl module can't hand the socket to kTLS, so TLS always
+        # takes the generator path. Measure that as the fallback baseline.
+        self._RunCase('tls (generator fallback)', image_path, [], tls=True)
+      self._RunCase('plain, generator', image_path, ['--disable-sendfile'])
+      self._RunCase('plain, sendfile', image_path, [])
+    finally:
+      shutil.rmtree(image_path)
+
+  def _WriteImage(self, image_path):
+    os.mkdir(os.path.join(image_path, self._IMAGE_TYPE))
+    with open(os.path.join(image_path, self._IMAGE_TYPE, self._IMAGE_NAME), 'wb') as fh:
+      remaining = self._image_size
+      while remaining > 0:
+        block = os.urandom(min(self._BLOCK_SIZE, remaining))
+        fh.write(block)
+        remaining -= len(block)
+
+  def _FreePort(self):
+    with socket.socket() as sock:
+      sock.bind(('127.0.0.1', 0))
+      return sock.getsockname()[1]
+
+  def _RunCase(self, name, image_path, extra_args, tls=False):
+    port = self._FreePort()
+    args = [
+      sys.executable,
+      os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'server.py'),
+      '--listen-host', '127.0.0.1',
+      '--listen-port', str(port),
+      '--image-path', image_path,
+      '--image-type', self._IMAGE_TYPE,
+      '--ca-cert', self._tls_args.get('ca_cert') or '/dev/null',
+    ]
+    if tls:
+      args.extend([
+        '--server-key', self._tls_args['server_key'],
+        '--server-cert', self._tls_args['server_cert'],
+      ])
+    else:
+      args.append('--insecure')
+    args.extend(extra_args)
+
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    try:
+      self._WaitForPort(port)
+      start_cpu = self._ProcessCPUTime(proc.pid)
+      start = time.monotonic()
+      with concurrent.futures.ThreadPoolExecutor(self._connections) as executor:
+        total = sum(executor.map(lambda _: self._Fetch(port, tls), range(self._requests)))
+      elapsed = time.monotonic() - start
+      cpu = self._ProcessCPUTime(proc.pid) - start_cpu
+    finally:
+      proc.terminate()
+      proc.wait()
+
+    print('%-28s %8.1f MiB/s %8.1f MiB/s per server core (%.2fs cpu)' % (
+      name,
+      total / elapsed / 2 ** 20,
+      total / max(cpu, 1e-6) / 2 ** 20,
+      cpu))
+
+  def _WaitForPort(self, port):
+    for _ in range(100):
+      try:
+        socket.create_connection(('127.0.0.1', port)).close()
+        return
+      except ConnectionRefusedError:
+        time.sleep(0.1)
+    raise RuntimeError('server did not start on port %d' % port)
+
+  def _ProcessCPUTime(self, pid):
+    with open('/proc/%d/stat' % pid, 'r') as fh:
+      # Fields after the parenthesised command name; utime and stime are 14
+      # and 15 in proc(5).
+      fields = fh.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+  def _Fetch(self, port, tls):
+    if tls:
+      context = ssl.create_default_context(cafile=self._tls_args['ca_cert'])
+      context.check_hostname = False
+      context.load_cert_chain(self._tls_args['client_cert'], self._tls_args['client_key'])
+      conn = http.client.HTTPSConnection('127.0.0.1', port, context=context)
+    else:
+      conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+      conn.request('GET', '/image/%s/%s' % (self._IMAGE_TYPE, self._IMAGE_NAME))
+      resp = conn.getresponse()
+      assert resp.status == 200, resp.status
+      expected = int(resp.getheader('Content-Length'))
+      received = 0
+      while True:
+        block = resp.read(self._BLOCK_SIZE)
+        if not block:
+          break
+        received += len(block)
+      assert received == expected, (received, expected)
+      return received
+    finally:
+      conn.close()
+
+
+def main():
+  tls_args = {}
+  if FLAGS.server_key and FLAGS.server_cert:
+    tls_args = {
+      'ca_cert': FLAGS.ca_cert,
+      'client_cert': FLAGS.client_cert,
+      'client_key': FLAGS.client_key,
+      'server_cert': FLAGS.server_cert,
+      'server_key': FLAGS.server_key,
+    }
+  bench = Benchmark(FLAGS.image_size_mb, FLAGS.connections, FLAGS.requests, tls_args)
+  bench.Run()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'client'))
+import wire
+
+
+parser = argparse.ArgumentParser(description='iconograph bench_report_encoding')
+parser.add_argument(
+    '--hosts',
+    dest='hosts',
+    type=int,
+    action='store',
+    default=100)
+parser.add_argument(
+    '--reports',
+    dest='reports',
+    type=int,
+    action='store',
+    default=10000)
+FLAGS = parser.parse_args()
+
+
+class Benchmark(object):
+  # Replays the same slave report stream through each codec and reports
+  # bytes on the wire and server-side decode CPU time. Each host sends one
+  # full report, then mostly heartbeats with the occasional delta, like
+  # Client._SendReport.
+
+  def __init__(self, hosts, reports):
+    self._hosts = hosts
+    self._reports = reports
+
+  def _Stream(self):
+    rand = random.Random(0)
+    timestamp = int(time.time())
+    messages = {}
+    for i in range(self._hosts):
+      messages[i] = [{
+        'type': 'report',
+        'data': {
+          'hostname': 'host-%05d.example.com' % i,
+          'image_type': 'server',
+          'timestamp': timestamp,
+          'next_timestamp': timestamp,
+          'volume_id': '%d-%032x' % (timestamp, rand.getrandbits(128)),
+          'next_volume_id': '%d-%032x' % (timestamp, rand.getrandbits(128)),
+          'uptime_seconds': rand.randrange(10 ** 6),
+        },
+      }]
+    stream = []
+    while len(stream) < self._reports:
+      host = rand.randrange(self._hosts)
+      if not messages[host]:
+        if rand.random() < 0.1:
+          messages[host].append({
+            'type': 'report_delta',
+            'data': {
+              'next_timestamp': timestamp + rand.randrange(3600),
+              'status': 'Fetching image...',
+            },
+            'removed': [],
+          })
+        else:
+          messages[host].append({'type': 'heartbeat'})
+      stream.append((host, messages[host].pop()))
+    return stream
+
+  @staticmethod
+  def _FrameOverhead(length):
+    # Client-to-server frames: 2 header bytes, extended length, 4 mask bytes.
+    if length < 126:
+      return 6
+    elif length < 2 ** 16:
+      return 8
+    return 14
+
+  def Run(self):
+    stream = self._Stream()
+    print('%d reports from %d hosts' % (len(stream), self._hosts))
+    for protocol in wire.Codec.Protocols():
+      # One codec pair per connection, as the deflate context is per stream.
+      clients = {}
+      servers = {}
+      encoded = []
+      for host, msg in stream:
+        if host not in clients:
+          clients[host] = wire.Codec(protocol)
+          servers[host] = wire.Codec(protocol)
+        data = clients[host].Encode(msg)
+        encoded.append((host, data))
+
+      wire_bytes = sum(len(x) + self._FrameOverhead(len(x)) for _, x in encoded)
+      start = time.process_time()
+      for host, data in encoded:
+        servers[host].Decode(data)
+      cpu = time.process_time() - start
+
+      print('%-34s %10d bytes %8.1f bytes/report %8.2f ms server CPU per 10k reports' % (
+        protocol,
+        wire_bytes,
+        wire_bytes / len(encoded),
+        cpu * 1000 * 10000 / len(encoded)))
+
+
+def main():
+  bench = Benchmark(FLAGS.hosts, FLAGS.reports)
+  bench.Run()
+
+
+if __name__ == '__main__':
+  main()
@@ -5,10 +5,14 @@ import hashlib
 import json
 import os
 import re
-import subprocess
 import sys
+import tempfile
 import time
 
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'client'))
+import delta
+import iso9660
+
 
 parser = argparse.ArgumentParser(description='iconograph fetcher')
 parser.add_argument(
@@ -38,8 +42,8 @@ FLAGS = parser.parse_args()
 class ManifestBuilder(object):
 
   _FILE_REGEX = re.compile('^(?P<timestamp>\d+)\.iso$')
-  _VOLUME_ID_REGEX = re.compile(b'^Volume id: (?P<volume_id>.+)$', re.MULTILINE)
-  _BUF_SIZE = 2 ** 16
+  # Must be a multiple of delta.BLOCK_SIZE
+  _CHUNK_SIZE = 2 ** 25
 
   def __init__(self, image_dir, old_manifest):
     self._image_dir = image_dir
@@ -57,14 +61,45 @@ class ManifestBuilder(object):
     except FileNotFoundError:
       return {}
 
-  def _GetVolumeID(self, path):
-    isoinfo = subprocess.check_output([
-      'isoinfo',
-      '-d',
-      '-i', path,
-    ])
-    match = self._VOLUME_ID_REGEX.search(isoinfo)
-    return match.group('volume_id').decode('ascii')
+  def _HashImage(self, path, image):
+    hash_obj = hashlib.sha256()
+    chunk_hash_obj = hashlib.sha256()
+    chunk_len = 0
+    image['chunk_size'] = self._CHUNK_SIZE
+    image['chunks'] = []
+    index_builder = delta.BlockIndexBuilder()
+    with open(path, 'rb') as fh:
+      while True:
+        data = fh.read(delta.BLOCK_SIZE)
+        if not data:
+          break
+        hash_obj.update(data)
+        index_builder.Update(data)
+        chunk_hash_obj.update(data)
+        chunk_len += len(data)
+        if chunk_len == self._CHUNK_SIZE:
+          image['chunks'].append(chunk_hash_obj.hexdigest())
+          chunk_hash_obj = hashlib.sha256()
+          chunk_len = 0
+    if chunk_len:
+      image['chunks'].append(chunk_hash_obj.hexdigest())
+    image['hash'] = hash_obj.hexdigest()
+    image['size'] = os.path.getsize(path)
+    return index_builder.Index()
+
+  def _WriteBlockIndex(self, timestamp, block_index):
+    path = os.path.join(self._image_dir, '%d.blocks.json' % timestamp)
+    index_bytes = json.dumps(block_index, separators=(',', ':')).encode('utf8')
+    with tempfile.NamedTemporaryFile(dir=self._image_dir, delete=False) as fh:
+      try:
+        fh.write(index_bytes)
+        fh.flush()
+        os.fchmod(fh.fileno(), 0o644)
+        os.rename(fh.name, path)
+      except:
+        os.unlink(fh.name)
+        raise
+    return hashlib.sha256(index_bytes).hexdigest()
 
   def BuildManifest(self):
     ret = {
@@ -86,20 +121,16 @@ class ManifestBuilder(object):
       old_image = old_images.get(timestamp)
       if old_image:
         image.update(old_image)
-        continue
+        if 'block_index_hash' in image and 'chunks' in image:
+          continue
 
       image_path = os.path.join(self._image_dir, filename)
 
-      image['volume_id'] = self._GetVolumeID(image_path)
+      if 'volume_id' not in image:
+        image['volume_id'] = iso9660.GetVolumeID(image_path)
 
-      with open(image_path, 'rb') as fh:
-        hash_obj = hashlib.sha256()
-        while True:
-          data = fh.read(self._BUF_SIZE)
-          if not data:
-            break
-          hash_obj.update(data)
-        image['hash'] = hash_obj.hexdigest()
+      block_index = self._HashImage(image_path, image)
+      image['block_index_hash'] = self._WriteBlockIndex(timestamp, block_index)
 
     ret['images'].sort(key=lambda x: x['timestamp'], reverse=True)
     return ret
@@ -112,6 +143,10 @@ class ManifestBuilder(object):
       print('Deleting old image:', filename, file=sys.stderr)
       path = os.path.join(self._image_dir, filename)
       os.unlink(path)
+      try:
+        os.unlink(os.path.join(self._image_dir, '%d.blocks.json' % image['timestamp']))
+      except FileNotFoundError:
+        pass
     manifest['images'] = manifest['images'][:max_images]
 
 
@@ -23,6 +23,12 @@ parser.add_argument(
     '--https-ca-cert',
     dest='https_ca_cert',
     action='store')
+parser.add_argument(
+    '--peer-port',
+    dest='peer_port',
+    action='store',
+    type=int,
+    default=0)
 parser.add_argument(
     '--server',
     dest='server',
@@ -34,8 +40,8 @@ FLAGS = parser.parse_args()
 def main():
   module = icon_lib.IconModule(FLAGS.chroot_path)
   module.InstallPackages(
-      'upstart', 'daemontools-run', 'genisoimage', 'git', 'python3-openssl',
-      'python3-requests', 'python3-ws4py')
+      'upstart', 'daemontools-run', 'git', 'python3-openssl',
+      'python3-msgpack', 'python3-requests', 'python3-ws4py')
 
   os.makedirs(os.path.join(FLAGS.chroot_path, 'icon', 'config'), exist_ok=True)
 
@@ -60,6 +66,10 @@ def main():
     fh.write('--server=%(server)s\n' % {
       'server': FLAGS.server,
     })
+    if FLAGS.peer_port:
+      fh.write('--peer-port=%(peer_port)d\n' % {
+        'peer_port': FLAGS.peer_port,
+      })
 
   os.symlink(
       '/icon/iconograph/client',
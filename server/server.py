@@ -1,19 +1,40 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
+import email.utils
+import fnmatch
+import hashlib
+import gevent
+import gevent.lock
+import gevent.os
+import gevent.queue
+import gevent.server
+import gevent.socket
+import gevent.subprocess
 import json
 import os
 import pyinotify
+import random
+import re
+import signal
+import socket
 import ssl
-import subprocess
+import struct
 import sys
+import tempfile
 import threading
 import time
+import urllib.parse
 import uuid
+from ws4py import messaging
 from ws4py import websocket
 from ws4py.server import geventserver
 from ws4py.server import wsgiutils
 
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'client'))
+import wire
+
 
 parser = argparse.ArgumentParser(description='iconograph https_server')
 parser.add_argument(
@@ -21,6 +42,66 @@ parser.add_argument(
     dest='ca_cert',
     action='store',
     required=True)
+parser.add_argument(
+    '--disable-sendfile',
+    dest='disable_sendfile',
+    action='store_true',
+    help='Never send images with sendfile(); it is only used with --insecure')
+parser.add_argument(
+    '--drain-timeout-seconds',
+    dest='drain_timeout_seconds',
+    type=float,
+    action='store',
+    default=600.0)
+parser.add_argument(
+    '--fleet-update-seconds',
+    dest='fleet_update_seconds',
+    type=float,
+    action='store',
+    default=1.0)
+parser.add_argument(
+    '--heartbeat-seconds',
+    dest='heartbeat_seconds',
+    type=float,
+    action='store',
+    default=20.0)
+parser.add_argument(
+    '--heartbeat-timeout-seconds',
+    dest='heartbeat_timeout_seconds',
+    type=float,
+    action='store',
+    default=60.0)
+parser.add_argument(
+    '--history-path',
+    dest='history_path',
+    action='store')
+parser.add_argument(
+    '--history-segment-seconds',
+    dest='history_segment_seconds',
+    type=int,
+    action='store',
+    default=3600,
+    help='Length of each history segment; each starts with a full snapshot')
+parser.add_argument(
+    '--history-detail-seconds',
+    dest='history_detail_seconds',
+    type=int,
+    action='store',
+    default=7 * 24 * 3600)
+parser.add_argument(
+    '--history-snapshot-seconds',
+    dest='history_snapshot_seconds',
+    type=int,
+    action='store',
+    default=90 * 24 * 3600,
+    help='How long to keep snapshots after their segment is gone')
+parser.add_argument(
+    '--history-sparse-snapshot-seconds',
+    dest='history_sparse_snapshot_seconds',
+    type=int,
+    action='store',
+    default=24 * 3600,
+    help='Beyond --history-detail-seconds, keep one snapshot per this long')
 parser.add_argument(
     '--image-path',
     dest='image_path',
@@ -31,6 +112,19 @@ parser.add_argument(
     dest='image_types',
     action='append',
     required=True)
+parser.add_argument(
+    '--insecure',
+    dest='insecure',
+    action='store_true',
+    help='Serve plain HTTP with no client certificate check when --server-key '
+         'and --server-cert are not given. Images are only sent with sendfile() '
+         'in this mode')
+parser.add_argument(
+    '--inotify-debounce-seconds',
+    dest='inotify_debounce_seconds',
+    type=float,
+    action='store',
+    default=0.5)
 parser.add_argument(
     '--listen-host',
     dest='listen_host',
@@ -42,16 +136,68 @@ parser.add_argument(
     type=int,
     action='store',
     default=443)
+parser.add_argument(
+    '--max-concurrent-downloads',
+    dest='max_concurrent_downloads',
+    type=int,
+    action='store',
+    default=0)
+parser.add_argument(
+    '--notify-wave-seconds',
+    dest='notify_wave_seconds',
+    type=float,
+    action='store',
+    default=10.0)
+parser.add_argument(
+    '--notify-wave-size',
+    dest='notify_wave_size',
+    type=int,
+    action='store',
+    default=100)
+parser.add_argument(
+    '--master-replay-events',
+    dest='master_replay_events',
+    type=int,
+    action='store',
+    default=1000)
+parser.add_argument(
+    '--max-reports-per-second',
+    dest='max_reports_per_second',
+    type=float,
+    action='store',
+    default=0)
+parser.add_argument(
+    '--reconnect-spread-seconds',
+    dest='reconnect_spread_seconds',
+    type=float,
+    action='store',
+    default=30.0)
+parser.add_argument(
+    '--report-interval-seconds',
+    dest='report_interval_seconds',
+    type=float,
+    action='store',
+    default=5.0)
+parser.add_argument(
+    '--max-report-interval-seconds',
+    dest='max_report_interval_seconds',
+    type=float,
+    action='store',
+    default=60.0)
+parser.add_argument(
+    '--watched-report-interval-seconds',
+    dest='watched_report_interval_seconds',
+    type=float,
+    action='store',
+    default=1.0)
 parser.add_argument(
     '--server-key',
     dest='server_key',
-    action='store',
-    required=True)
+    action='store')
 parser.add_argument(
     '--server-cert',
     dest='server_cert',
-    action='store',
-    required=True)
+    action='store')
 parser.add_argument(
     '--static-path',
     dest='static_paths',
@@ -60,14 +206,166 @@ parser.add_argument(
     '--exec-handler',
     dest='exec_handlers',
     action='append')
+parser.add_argument(
+    '--exec-cache',
+    dest='exec_cache',
+    action='append')
+parser.add_argument(
+    '--exec-concurrency',
+    dest='exec_concurrency',
+    type=int,
+    action='store',
+    default=4)
+parser.add_argument(
+    '--exec-timeout-seconds',
+    dest='exec_timeout_seconds',
+    type=float,
+    action='store',
+    default=60.0)
+parser.add_argument(
+    '--workers',
+    dest='workers',
+    type=int,
+    action='store',
+    default=1)
 FLAGS = parser.parse_args()
+# Without both, there's no TLS and no client certificate check, so plain
+# HTTP has to be asked for explicitly (e.g. for sendfile() benchmarks).
+if bool(FLAGS.server_key) != bool(FLAGS.server_cert):
+  parser.error('--server-key and --server-cert must be given together')
+if not FLAGS.server_key and not FLAGS.insecure:
+  parser.error('--server-key and --server-cert are required unless --insecure is given')
 
 
-class WebSockets(object):
+def FileETag(stat):
+  # Published files are always replaced by rename, so the inode changes
+  # whenever the contents do.
+  return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class Metrics(object):
+  # Prometheus text-format counters, gauges and histograms. Everything is
+  # updated from the gevent loop, so plain dict increments need no locking.
+
+  _BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
   def __init__(self):
+    self._counters = {}
+    self._histograms = {}
+    self._gauges = {}
+    self._levels = {}
+
+  @staticmethod
+  def Labels(**labels):
+    return tuple(sorted(labels.items()))
+
+  def Inc(self, name, value=1, **labels):
+    series = self._counters.setdefault(name, {})
+    key = self.Labels(**labels)
+    series[key] = series.get(key, 0) + value
+
+  def Add(self, name, value, **labels):
+    # Like Inc(), but for gauges that go up and down.
+    series = self._levels.setdefault(name, {})
+    key = self.Labels(**labels)
+    series[key] = series.get(key, 0) + value
+
+  def Level(self, name, **labels):
+    return self._levels.get(name, {}).get(self.Labels(**labels), 0)
+
+  def Total(self, name):
+    # Sum of a Level() across all label sets.
+    return sum(self._levels.get(name, {}).values())
+
+  def Count(self, name, **labels):
+    return self._counters.get(name, {}).get(self.Labels(**labels), 0)
+
+  def Observe(self, name, value, **labels):
+    series = self._histograms.setdefault(name, {})
+    key = self.Labels(**labels)
+    histogram = series.get(key)
+    if histogram is None:
+      # Per-bucket counts, then sum and count.
+      histogram = series[key] = [0] * (len(self._BUCKETS) + 2)
+    for i, bound in enumerate(self._BUCKETS):
+      if value <= bound:
+        histogram[i] += 1
+        break
+    histogram[-2] += value
+    histogram[-1] += 1
+
+  def Gauge(self, name, func):
+    # func is called at scrape time. It returns a number, or a dict mapping
+    # Labels() keys to numbers.
+    self._gauges[name] = func
+
+  @staticmethod
+  def _FormatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+      return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+  def Render(self):
+    lines = []
+    for name, series in sorted(self._counters.items()):
+      lines.append('# TYPE %s counter' % name)
+      for key, value in sorted(series.items()):
+        lines.append('%s%s %s' % (name, self._FormatLabels(key), value))
+    gauges = {
+      name: (func() if callable(func) else func)
+      for name, func in list(self._gauges.items()) + list(self._levels.items())
+    }
+    for name, value in sorted(gauges.items()):
+      lines.append('# TYPE %s gauge' % name)
+      series = value if isinstance(value, dict) else {(): value}
+      for key, value in sorted(series.items()):
+        lines.append('%s%s %s' % (name, self._FormatLabels(key), value))
+    for name, series in sorted(self._histograms.items()):
+      lines.append('# TYPE %s histogram' % name)
+      for key, histogram in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(self._BUCKETS, histogram):
+          cumulative += count
+          lines.append('%s_bucket%s %d' % (name, self._FormatLabels(key, [('le', bound)]), cumulative))
+        lines.append('%s_bucket%s %d' % (name, self._FormatLabels(key, [('le', '+Inf')]), histogram[-1]))
+        lines.append('%s_sum%s %s' % (name, self._FormatLabels(key), histogram[-2]))
+        lines.append('%s_count%s %d' % (name, self._FormatLabels(key), histogram[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class Subscription(object):
+  # What a master asked to see: image types and/or hostname glob patterns
+  # (e.g. 'web-*'). Either left out matches everything.
+
+  def __init__(self, image_types=None, hostnames=None):
+    self.image_types = frozenset(image_types) if image_types else None
+    self.hostnames = tuple(hostnames) if hostnames else None
+    self.key = (self.image_types, self.hostnames)
+
+  def MatchesImageType(self, image_type):
+    return self.image_types is None or image_type in self.image_types
+
+  def Matches(self, hostname, image_type):
+    if not self.MatchesImageType(image_type):
+      return False
+    if self.hostnames is None:
+      return True
+    return any(fnmatch.fnmatchcase(hostname, x) for x in self.hostnames)
+
+
+class WebSockets(object):
+  def __init__(self, replay_events=1000):
     self.slaves = set()
     self.masters = set()
     self.targets = {}
+    self.dropped_messages = 0
+    # Every master-bound event gets the next seq. A master that reconnects
+    # to the same server_id can resume from the last seq it saw, if that's
+    # still in the replay buffer.
+    self.server_id = uuid.uuid4().hex
+    self.seq = 0
+    self._replay = collections.deque(maxlen=replay_events)
 
   def __iter__(self):
     return iter(self.slaves | self.masters)
@@ -75,84 +373,751 @@ class WebSockets(object):
   @staticmethod
   def Broadcast(targets, msg):
     msgstr = json.dumps(msg)
-    for target in targets:
-      target.send(msgstr)
+    for target in list(targets):
+      target.Enqueue(msgstr)
+
+  @staticmethod
+  def PublishToSlaves(slaves, msg, serialized=None):
+    # Serialized once per protocol rather than once per slave. Pass the
+    # same serialized dict to share that across calls, e.g. rollout waves.
+    if serialized is None:
+      serialized = {}
+    for slave in list(slaves):
+      protocol = slave.codec.protocol
+      if protocol not in serialized:
+        serialized[protocol] = wire.Codec.Serialize(protocol, msg)
+      slave.Enqueue(serialized[protocol])
+
+  def QueueDepths(self):
+    return [x.QueueDepth() for x in self]
+
+  def MastersBySubscription(self):
+    groups = {}
+    for master in list(self.masters):
+      groups.setdefault(master.subscription.key, (master.subscription, []))[1].append(master)
+    return groups.values()
+
+  @staticmethod
+  def _Filtered(msg, seq, filter_func, subscription):
+    filtered = filter_func(msg, subscription)
+    if filtered:
+      filtered = dict(filtered, seq=seq)
+    return filtered
+
+  def PublishToMasters(self, msg, filter_func):
+    # filter_func(msg, subscription) returns what a master with that
+    # subscription should see, or None. It's encoded once per distinct
+    # subscription, not once per master.
+    self.seq += 1
+    self._replay.append((self.seq, msg, filter_func))
+    for subscription, masters in self.MastersBySubscription():
+      filtered = self._Filtered(msg, self.seq, filter_func, subscription)
+      if filtered:
+        self.Broadcast(masters, filtered)
+
+  def Replay(self, master, server_id, seq):
+    # Returns False if the master has to start over from a snapshot.
+    if server_id != self.server_id or seq > self.seq:
+      return False
+    if seq < self.seq and (not self._replay or self._replay[0][0] > seq + 1):
+      return False
+    for event_seq, msg, filter_func in self._replay:
+      if event_seq <= seq:
+        continue
+      filtered = self._Filtered(msg, event_seq, filter_func, master.subscription)
+      if filtered:
+        master.Enqueue(json.dumps(filtered))
+    return True
+
+
+class Fleet(object):
+  # Merges slave reports into per-host state and sends masters one batched
+  # diff per tick, instead of forwarding every report as it arrives.
+
+  # Report fields with a secondary index: value -> set of hostnames.
+  INDEXED_FIELDS = ('image_type', 'timestamp', 'next_timestamp')
+
+  def __init__(self, websockets, metrics, update_seconds, history=None):
+    self._websockets = websockets
+    self._metrics = metrics
+    self._update_seconds = update_seconds
+    self._history = history
+    self._reports = {}
+    self._received = {}
+    self._indexes = {field: {} for field in self.INDEXED_FIELDS}
+    self._sent = {}
+    self._last_received = {}
+    self._dirty = {}
+    self._dirty_since = {}
+    self._targets_added = set()
+    self._targets_removed = set()
+    self._remote_targets = set()
+    self._broker = None
 
-  def BroadcastTargets(self):
-    self.Broadcast(self.masters, {
-      'type': 'targets',
+  def SetBroker(self, broker):
+    self._broker = broker
+
+  def _Store(self, hostname, client, report):
+    old = self._reports.get(hostname, {})
+    for field, index in self._indexes.items():
+      old_value, new_value = old.get(field), report.get(field)
+      if old_value == new_value:
+        continue
+      if old_value is not None:
+        hostnames = index[str(old_value)]
+        hostnames.discard(hostname)
+        if not hostnames:
+          del index[str(old_value)]
+      if new_value is not None:
+        index.setdefault(str(new_value), set()).add(hostname)
+
+    self._reports[hostname] = report
+    self._received[hostname] = (int(time.time()), client)
+
+  def Update(self, hostname, client, report):
+    self._Store(hostname, client, report)
+    self._dirty[hostname] = self._received[hostname]
+    self._dirty_since.setdefault(hostname, time.monotonic())
+    self._metrics.Inc('iconograph_reports_total')
+
+  def Query(self, filters):
+    # filters maps field name to a string value. Indexed fields are
+    # intersected from their indexes; anything else is checked per host.
+    hostnames = None
+    for field, value in filters.items():
+      if field in self._indexes:
+        matches = self._indexes[field].get(value, set())
+        hostnames = matches if hostnames is None else hostnames & matches
+    if hostnames is None:
+      hostnames = self._reports.keys()
+    return {
+      hostname
+      for hostname in hostnames
+      if all(str(self._reports[hostname].get(field)) == value
+             for field, value in filters.items()
+             if field not in self._indexes)
+    }
+
+  def Count(self, field, hostnames=None):
+    if hostnames is None:
+      return {
+        value: len(matches)
+        for value, matches in self._indexes[field].items()
+      }
+    counts = {}
+    for hostname in hostnames:
+      value = self._reports[hostname].get(field)
+      if value is not None:
+        counts[str(value)] = counts.get(str(value), 0) + 1
+    return counts
+
+  def Get(self, hostname):
+    received, client = self._received[hostname]
+    return {
+      'received': received,
+      'client': client,
+      'data': self._reports[hostname],
+    }
+
+  def AddTarget(self, hostname):
+    if hostname in self._targets_removed:
+      self._targets_removed.remove(hostname)
+    else:
+      self._targets_added.add(hostname)
+
+  def RemoveTarget(self, hostname):
+    if hostname in self._targets_added:
+      self._targets_added.remove(hostname)
+    else:
+      self._targets_removed.add(hostname)
+
+  def _Matches(self, subscription, hostname):
+    return subscription.Matches(hostname, self._reports.get(hostname, {}).get('image_type'))
+
+  def Targets(self, subscription):
+    return [
+      x
+      for x in set(self._websockets.targets) | self._remote_targets
+      if self._Matches(subscription, x)
+    ]
+
+  def _Filter(self, msg, subscription):
+    data = msg['data']
+    filtered = {
+      'reports': {
+        hostname: report
+        for hostname, report in data['reports'].items()
+        if self._Matches(subscription, hostname)
+      },
+      'targets_added': [x for x in data['targets_added'] if self._Matches(subscription, x)],
+      'targets_removed': [x for x in data['targets_removed'] if self._Matches(subscription, x)],
+    }
+    if not any(filtered.values()):
+      return None
+    return {'type': msg['type'], 'data': filtered}
+
+  def _BroadcastToMasters(self, msg):
+    self._websockets.PublishToMasters(msg, self._Filter)
+
+  def SendCommand(self, target, msg):
+    # For a target on another worker; the broker knows which.
+    if self._broker and target in self._remote_targets:
+      self._broker.Publish({'op': 'command', 'target': target, 'msg': msg})
+
+  def ApplyRemote(self, msg):
+    # A fleet_update from another worker. Its masters already have it, so
+    # it goes straight to ours and into the sent state, not into _dirty.
+    data = msg['data']
+    for hostname, update in data['reports'].items():
+      report = dict(self._sent.get(hostname, {}))
+      report.update(update['data'])
+      for key in update['removed']:
+        report.pop(key, None)
+      self._Store(hostname, update['client'], report)
+      self._sent[hostname] = report
+      self._last_received[hostname] = (update['received'], update['client'])
+    self._remote_targets.update(data['targets_added'])
+    self._remote_targets.difference_update(data['targets_removed'])
+    self._BroadcastToMasters(msg)
+    if self._history and data['reports']:
+      self._history.Append(data['reports'])
+
+  def Snapshot(self, subscription):
+    # Masters apply diffs on top of what was last sent, so that's what a new
+    # master needs to start from.
+    return {
+      'type': 'fleet_update',
       'data': {
-        'targets': list(self.targets.keys()),
+        'reports': {
+          hostname: {
+            'received': received,
+            'client': client,
+            'data': self._sent[hostname],
+            'removed': [],
+          }
+          for hostname, (received, client) in self._last_received.items()
+          if self._Matches(subscription, hostname)
+        },
+        'targets_added': [],
+        'targets_removed': [],
       },
-    })
+    }
+
+  def Flush(self):
+    if not (self._dirty or self._targets_added or self._targets_removed):
+      return
+
+    reports = {}
+    for hostname, (received, client) in self._dirty.items():
+      report = self._reports[hostname]
+      sent = self._sent.get(hostname, {})
+      reports[hostname] = {
+        'received': received,
+        'client': client,
+        'data': {
+          key: value
+          for key, value in report.items()
+          if sent.get(key) != value
+        },
+        'removed': [key for key in sent if key not in report],
+      }
+      self._sent[hostname] = report
+    self._last_received.update(self._dirty)
+
+    msg = {
+      'type': 'fleet_update',
+      'data': {
+        'reports': reports,
+        'targets_added': sorted(self._targets_added),
+        'targets_removed': sorted(self._targets_removed),
+      },
+    }
+    self._dirty = {}
+    self._targets_added = set()
+    self._targets_removed = set()
+    self._BroadcastToMasters(msg)
+    if self._broker:
+      self._broker.Publish({'op': 'fleet_update', 'msg': msg})
+
+    # Time from a host's first unsent report to its fan-out to masters.
+    now = time.monotonic()
+    for since in self._dirty_since.values():
+      self._metrics.Observe('iconograph_report_fanout_seconds', now - since)
+    self._dirty_since = {}
+    if self._history and reports:
+      self._history.Append(reports)
+
+  def Loop(self):
+    while True:
+      gevent.sleep(self._update_seconds)
+      self.Flush()
+
+
+class ReportHistory(object):
+  # Append-only log of per-host report changes. Each segment file covers
+  # segment_seconds and starts with a snapshot of every host's state at its
+  # start time, written alongside as snapshot-<time>.json. Segments older
+  # than detail_seconds are deleted. Their snapshots are thinned to one per
+  # sparse_snapshot_seconds and kept until snapshot_seconds, so older
+  # history has coarser steps instead of growing without bound.
+  #
+  # All file I/O runs in the gevent threadpool, which has several threads.
+  # _lock keeps queries from reading files that a write is appending to or
+  # compaction is deleting.
+
+  _WRITE_SECONDS = 5.0
+
+  def __init__(self, path, segment_seconds, detail_seconds, snapshot_seconds, sparse_snapshot_seconds):
+    self._path = path
+    self._segment_seconds = segment_seconds
+    self._detail_seconds = detail_seconds
+    self._snapshot_seconds = snapshot_seconds
+    self._sparse_snapshot_seconds = sparse_snapshot_seconds
+    self._lock = threading.Lock()
+    self._pending = []
+    self._state = {}
+    self._segment = None
+    self._segment_start = None
+
+  def Append(self, reports):
+    # reports is the per-host diff Fleet just sent to masters.
+    self._pending.append(reports)
+
+  def Loop(self):
+    threadpool = gevent.get_hub().threadpool
+    threadpool.apply(self._Restore)
+    while True:
+      gevent.sleep(self._WRITE_SECONDS)
+      pending, self._pending = self._pending, []
+      threadpool.apply(self._Write, (pending, int(time.time())))
+
+  def Flush(self):
+    # Writes out what's pending straight away, for a process about to exec.
+    # Blocks the hub, but only for one write.
+    pending, self._pending = self._pending, []
+    with self._lock:
+      if self._segment:
+        self._WriteLocked(pending, int(time.time()))
+
+  def Query(self, start, end, hostname=None):
+    return gevent.get_hub().threadpool.apply(self._Query, (start, end, hostname))
+
+  def _Boundaries(self):
+    boundaries = set()
+    for file_name in os.listdir(self._path):
+      match = re.match(r'^(?:segment|snapshot)-(\d+)\.json(?:l)?$', file_name)
+      if match:
+        boundaries.add(int(match.group(1)))
+    return sorted(boundaries)
+
+  def _SegmentPath(self, boundary):
+    return os.path.join(self._path, 'segment-%d.jsonl' % boundary)
+
+  def _SnapshotPath(self, boundary):
+    return os.path.join(self._path, 'snapshot-%d.json' % boundary)
+
+  def _Apply(self, state, record):
+    host_state = state.setdefault(record['h'], {})
+    host_state.update(record.get('d', {}))
+    for key in record.get('r', []):
+      host_state.pop(key, None)
+
+  def _Record(self, hostname, received, report):
+    # Stores boot_time instead of uptime_seconds, which would otherwise
+    # change on every report.
+    data = dict(report['data'])
+    removed = [x for x in report['removed'] if x != 'uptime_seconds']
+    host_state = self._state.get(hostname, {})
+    uptime = data.pop('uptime_seconds', None)
+    if uptime is not None:
+      boot_time = received - uptime
+      if abs(boot_time - host_state.get('boot_time', 0)) > 60:
+        data['boot_time'] = boot_time
+    data = {
+      key: value
+      for key, value in data.items()
+      if host_state.get(key) != value
+    }
+    if not data and not removed:
+      return None
+    record = {'t': received, 'h': hostname}
+    if data:
+      record['d'] = data
+    if removed:
+      record['r'] = removed
+    return record
+
+  def _Restore(self):
+    with self._lock:
+      self._RestoreLocked()
+
+  def _RestoreLocked(self):
+    os.makedirs(self._path, exist_ok=True)
+    boundaries = self._Boundaries()
+    if boundaries:
+      self._state = self._Replay(boundaries[-1:], None, None, None)[0]
+    self._Rotate(int(time.time()))
+
+  def _Rotate(self, now):
+    if self._segment:
+      self._segment.close()
+    self._segment_start = now
+    tmp_path = self._SnapshotPath(now) + '.tmp'
+    with open(tmp_path, 'w') as fh:
+      json.dump(self._state, fh, separators=(',', ':'))
+    os.rename(tmp_path, self._SnapshotPath(now))
+    self._segment = open(self._SegmentPath(now), 'a')
+    self._Compact(now)
+
+  def _Compact(self, now):
+    # The newest snapshot is always kept; _Restore starts from it. A
+    # snapshot never goes before its segment, which _Replay needs it for.
+    snapshot_seconds = max(self._snapshot_seconds, self._detail_seconds)
+    kept = set()
+    for boundary in self._Boundaries()[:-1]:
+      paths = []
+      if boundary < now - self._detail_seconds:
+        paths.append(self._SegmentPath(boundary))
+        # The first snapshot in each sparse interval stays.
+        interval = boundary // self._sparse_snapshot_seconds
+        if boundary < now - snapshot_seconds or interval in kept:
+          paths.append(self._SnapshotPath(boundary))
+        kept.add(interval)
+      for path in paths:
+        try:
+          os.unlink(path)
+        except FileNotFoundError:
+          pass
+
+  def _Write(self, pending, now):
+    with self._lock:
+      self._WriteLocked(pending, now)
+
+  def _WriteLocked(self, pending, now):
+    lines = []
+    for reports in pending:
+      for hostname, report in reports.items():
+        record = self._Record(hostname, report['received'], report)
+        if record:
+          self._Apply(self._state, record)
+          lines.append(json.dumps(record, separators=(',', ':')))
+    if lines:
+      self._segment.write('\n'.join(lines) + '\n')
+      self._segment.flush()
+    if now - self._segment_start >= self._segment_seconds:
+      self._Rotate(now)
+
+  def _Replay(self, boundaries, start, end, hostname):
+    # Returns (state at start, events in (start, end]). Where a segment has
+    # been compacted away, changes between snapshots show up as events at
+    # the later snapshot's time.
+    state = {}
+    start_state = None
+    events = []
+    for boundary in boundaries:
+      if end is not None and boundary > end:
+        break
+      with open(self._SnapshotPath(boundary), 'r') as fh:
+        snapshot = json.load(fh)
+      if hostname is not None:
+        snapshot = {hostname: snapshot[hostname]} if hostname in snapshot else {}
+      if start is None or boundary <= start:
+        state = snapshot
+      else:
+        for host, host_state in snapshot.items():
+          old = state.get(host, {})
+          record = {
+            't': boundary,
+            'h': host,
+            'd': {k: v for k, v in host_state.items() if old.get(k) != v},
+            'r': [k for k in old if k not in host_state],
+          }
+          if record['d'] or record['r']:
+            if start_state is None:
+              start_state = {k: dict(v) for k, v in state.items()}
+            events.append(record)
+          state[host] = dict(host_state)
+      try:
+        with open(self._SegmentPath(boundary), 'r') as fh:
+          for line in fh:
+            record = json.loads(line)
+            if hostname is not None and record['h'] != hostname:
+              continue
+            if end is not None and record['t'] > end:
+              break
+            if start is not None and record['t'] > start:
+              if start_state is None:
+                start_state = {k: dict(v) for k, v in state.items()}
+              events.append(record)
+            self._Apply(state, record)
+      except FileNotFoundError:
+        pass
+    return (state if start_state is None else start_state), events
+
+  def _Query(self, start, end, hostname):
+    with self._lock:
+      boundaries = self._Boundaries()
+      first = 0
+      for i, boundary in enumerate(boundaries):
+        if boundary <= start:
+          first = i
+      state, events = self._Replay(boundaries[first:], start, end, hostname)
+    return {
+      'start': start,
+      'end': end,
+      'state': state,
+      'events': events,
+    }
 
 
 class BaseWSHandler(websocket.WebSocket):
+  # Each connection gets its own bounded queue and writer greenlet, so one
+  # slow peer can't hold up a broadcast to everyone else.
+
+  _SEND_QUEUE_SIZE = 256
+
+  last_seen = None
+
   def opened(self, image_types):
-    self.send(json.dumps({
+    self.last_seen = time.monotonic()
+    # Reap() takes the socket away, and peer_address needs it.
+    self._peer = self.peer_address
+    self._write_lock = gevent.lock.Semaphore()
+    self._send_queue = gevent.queue.Queue(self._SEND_QUEUE_SIZE)
+    self._writer = gevent.spawn(self._Writer)
+    self.Enqueue(json.dumps({
       'type': 'image_types',
       'data': {
         'image_types': list(image_types),
       },
     }))
 
+  def closed(self, code, reason=None):
+    self._writer.kill(block=False)
+    self._Forget()
+
+  def process(self, data):
+    # Any frame counts as a sign of life, pongs included.
+    self.last_seen = time.monotonic()
+    return super().process(data)
+
+  def _write(self, b):
+    # ws4py writes pongs and close replies itself, from the reader, so this
+    # is where they're kept from interleaving with a frame the writer is
+    # halfway through; sendall() can yield partway.
+    with self._write_lock:
+      super()._write(b)
+
+  def unhandled_error(self, error):
+    # Usually just a peer going away, or Reap() closing the socket under
+    # the reader. ws4py would log a full traceback for each.
+    print('Connection to %s lost: %r' % (self._peer, error))
+
+  def Enqueue(self, msgstr):
+    try:
+      self._send_queue.put_nowait(msgstr)
+    except gevent.queue.Full:
+      self._Overflow(msgstr)
 
-def GetSlaveWSHandler(image_types, websockets):
+  def QueueDepth(self):
+    return self._send_queue.qsize()
+
+  def CloseWhenSent(self, code, reason):
+    # Closes once everything already queued has gone out.
+    try:
+      self._send_queue.put_nowait(lambda: self.close(code=code, reason=reason))
+    except gevent.queue.Full:
+      self.close(code=code, reason=reason)
+
+  def Ping(self):
+    # Queued behind whatever is already waiting, so a busy connection isn't
+    # pinged ahead of its own traffic.
+    self.Enqueue(lambda: self.send(messaging.PingControlMessage(b'')))
+
+  def Reap(self):
+    # A half-open connection never gets closed(), so forget it now and drop
+    # the socket, which ends the reader with an error.
+    if self._writer is not gevent.getcurrent():
+      self._writer.kill(block=False)
+    self._Forget()
+    self.close_connection()
+
+  def _Forget(self):
+    raise NotImplementedError
+
+  def _Overflow(self, msgstr):
+    raise NotImplementedError
+
+  def _SendMessage(self, msgstr):
+    self.send(msgstr)
+
+  def _Writer(self):
+    for msgstr in self._send_queue:
+      try:
+        if callable(msgstr):
+          msgstr()
+        else:
+          self._SendMessage(msgstr)
+      except Exception as e:
+        # Without a writer the connection would stay open but never send
+        # anything again, so take it down and let the peer reconnect.
+        print('Send to %s failed: %r' % (self._peer, e))
+        self.Reap()
+        return
+      if self.client_terminated:
+        # We sent a close frame; nothing more can follow it.
+        return
+
+
+def GetSlaveWSHandler(image_types, websockets, fleet):
 
   class SlaveWSHandler(BaseWSHandler):
     _hostname = None
+    _report = None
+    _uptime_base = None
+    report_interval = None
+    codec = None
 
     def opened(self):
+      self.codec = wire.Codec.ForProtocols(self.protocols)
       super().opened(image_types)
       websockets.slaves.add(self)
 
-    def closed(self, code, reason=None):
-      websockets.slaves.remove(self)
-      if self._hostname:
+    def _SendMessage(self, data):
+      # Broadcasts arrive already serialized for our protocol (see
+      # WebSockets.PublishToSlaves). Anything else is a JSON string, which
+      # binary slaves need re-encoded.
+      if not self.codec.binary:
+        self.send(data)
+        return
+      if isinstance(data, str):
+        data = wire.Codec.Serialize(self.codec.protocol, json.loads(data))
+      self.send(self.codec.Frame(data), binary=True)
+
+    def Report(self):
+      return self._report
+
+    def _Forget(self):
+      # Called from both closed() and Reap(), so only the first removes the
+      # target.
+      websockets.slaves.discard(self)
+      if self._hostname and websockets.targets.get(self._hostname) is self:
         del websockets.targets[self._hostname]
-        websockets.BroadcastTargets()
+        fleet.RemoveTarget(self._hostname)
 
-    def received_message(self, msg):
-      parsed = json.loads(str(msg))
+    def _Overflow(self, msgstr):
+      # A slave this far behind is stuck; it'll reconnect and resync. A
+      # close frame would only queue up behind everything else on the same
+      # stuck socket, so drop the transport outright.
+      websockets.dropped_messages += self.QueueDepth() + 1
+      self.Reap()
+
+    def _MergeReport(self, parsed):
+      # Clients send a full report once, then only changed fields or bare
+      # heartbeats. Rebuild the full report that masters expect.
       if parsed['type'] == 'report':
-        newmsg = {
-          'type': 'report',
-          'id': str(uuid.uuid4()),
-          'received': int(time.time()),
-          'client': self.peer_address,
-          'data': parsed['data'],
-        }
-        websockets.Broadcast(websockets.masters, newmsg)
+        self._report = dict(parsed['data'])
+        if 'uptime_seconds' in self._report:
+          self._uptime_base = (self._report['uptime_seconds'], time.time())
+      elif parsed['type'] == 'report_delta':
+        self._report = self._report or {}
+        self._report.update(parsed['data'])
+        for key in parsed.get('removed', []):
+          self._report.pop(key, None)
+      elif parsed['type'] != 'heartbeat' or self._report is None:
+        return None
+
+      report = dict(self._report)
+      if self._uptime_base:
+        uptime, received = self._uptime_base
+        report['uptime_seconds'] = uptime + int(time.time() - received)
+      return report
+
+    def received_message(self, msg):
+      parsed = self.codec.Decode(msg.data)
+      report = self._MergeReport(parsed)
+      if report is None:
+        return
+
+      hostname = report.get('hostname')
+      if not hostname:
+        return
 
-        if 'hostname' in parsed['data']:
-          self._hostname = parsed['data']['hostname']
-          websockets.targets[self._hostname] = self
-          websockets.BroadcastTargets()
+      if hostname != self._hostname:
+        if self._hostname and websockets.targets.get(self._hostname) is self:
+          del websockets.targets[self._hostname]
+          fleet.RemoveTarget(self._hostname)
+        self._hostname = hostname
+        websockets.targets[self._hostname] = self
+        fleet.AddTarget(self._hostname)
+
+      if self.report_interval:
+        # So masters know how stale is too stale for this host.
+        report['report_interval'] = self.report_interval
+      fleet.Update(hostname, self.peer_address, report)
 
   return SlaveWSHandler
 
 
-def GetMasterWSHandler(image_types, websockets):
+def GetMasterWSHandler(image_types, websockets, fleet):
   class MasterWSHandler(BaseWSHandler):
+    subscription = Subscription()
+
     def opened(self):
+      # ?image_types=a,b&hostnames=web-*: same as a subscribe message.
+      # ?server_id=X&seq=N: resume after the last event seen, if possible.
+      args = dict(urllib.parse.parse_qsl(self.environ.get('QUERY_STRING', '')))
+      if 'image_types' in args or 'hostnames' in args:
+        self.subscription = Subscription(
+            args['image_types'].split(',') if args.get('image_types') else None,
+            args['hostnames'].split(',') if args.get('hostnames') else None)
+
       super().opened(image_types)
       websockets.masters.add(self)
-      self.send(json.dumps({
+      try:
+        resumed = websockets.Replay(self, args.get('server_id'), int(args.get('seq', -1)))
+      except ValueError:
+        resumed = False
+      if not resumed:
+        self._SendSnapshot()
+
+    def _Forget(self):
+      websockets.masters.discard(self)
+
+    def _SendSnapshot(self):
+      # Stamped with the seq of the last event it includes.
+      self.Enqueue(json.dumps({
         'type': 'targets',
+        'server_id': websockets.server_id,
+        'seq': websockets.seq,
         'data': {
-          'targets': list(websockets.targets.keys()),
+          'targets': fleet.Targets(self.subscription),
         },
       }))
+      self.Enqueue(json.dumps(dict(
+          fleet.Snapshot(self.subscription),
+          server_id=websockets.server_id,
+          seq=websockets.seq)))
 
-    def closed(self, code, reason=None):
-      websockets.masters.remove(self)
+    def _Overflow(self, msgstr):
+      # The queue also holds new_manifest and command traffic that a
+      # snapshot wouldn't bring back, so drop the connection. The dashboard
+      # reconnects with its last seq and gets the missed events replayed,
+      # or a snapshot if they've left the replay buffer.
+      websockets.dropped_messages += self.QueueDepth() + 1
+      self.Reap()
 
     def received_message(self, msg):
       parsed = json.loads(str(msg))
-      if parsed['type'] == 'command':
+      if parsed['type'] == 'subscribe':
+        # Replaces any earlier subscription, so the dashboard starts over
+        # from a snapshot of just what it asked for.
+        self.subscription = Subscription(
+            parsed['data'].get('image_types'),
+            parsed['data'].get('hostnames'))
+        self._SendSnapshot()
+      elif parsed['type'] == 'command':
         target = parsed['target']
-        if target not in websockets.targets:
-          return
         newmsg = {
           'type': 'command',
           'target': target,
@@ -161,26 +1126,340 @@ def GetMasterWSHandler(image_types, websockets):
           'client': self.peer_address,
           'data': parsed['data'],
         }
-        websockets.targets[target].send(json.dumps(newmsg))
+        if target in websockets.targets:
+          websockets.targets[target].Enqueue(json.dumps(newmsg))
+        else:
+          fleet.SendCommand(target, newmsg)
 
   return MasterWSHandler
 
 
-class INotifyHandler(pyinotify.ProcessEvent):
-  def __init__(self, websockets):
+class HeartbeatMonitor(object):
+  # Pings every slave and master each interval. A connection we've heard
+  # nothing from, not even a pong, for timeout seconds is reaped.
+
+  def __init__(self, websockets, metrics, interval, timeout):
+    self._websockets = websockets
+    self._metrics = metrics
+    self._interval = interval
+    self._timeout = timeout
+
+  def Loop(self):
+    while True:
+      gevent.sleep(self._interval)
+      now = time.monotonic()
+      for role, handlers in (('slave', self._websockets.slaves), ('master', self._websockets.masters)):
+        for handler in list(handlers):
+          if now - handler.last_seen > self._timeout:
+            self._metrics.Inc('iconograph_websockets_reaped_total', role=role)
+            handler.Reap()
+          else:
+            handler.Ping()
+
+
+class ReportIntervalController(object):
+  # Tells slaves how often to report. The fleet-wide interval stretches as
+  # ingest approaches max_reports_per_second. Hosts picked out by a master's
+  # hostname subscription report at watched_interval instead.
+
+  _UPDATE_SECONDS = 10.0
+
+  def __init__(self, websockets, metrics, interval, max_interval, watched_interval, max_reports_per_second):
     self._websockets = websockets
+    self._metrics = metrics
+    self._interval = interval
+    self._max_interval = max_interval
+    self._watched_interval = watched_interval
+    self._max_reports_per_second = max_reports_per_second
+    self._fleet_interval = interval
+
+  def _FleetInterval(self, reports_per_second):
+    if not self._max_reports_per_second:
+      return self._interval
+    # Reports scale inversely with the interval, so stretch it by how far
+    # over budget the current rate would be at the base interval.
+    rate_at_base = reports_per_second * self._fleet_interval / self._interval
+    scale = max(1.0, rate_at_base / self._max_reports_per_second)
+    return min(self._interval * scale, self._max_interval)
+
+  def _Watched(self, slave):
+    report = slave.Report()
+    if not report or 'hostname' not in report:
+      return False
+    for master in self._websockets.masters:
+      if (master.subscription.hostnames and
+          master.subscription.Matches(report['hostname'], report.get('image_type'))):
+        return True
+    return False
+
+  def Loop(self):
+    last_count = self._metrics.Count('iconograph_reports_total')
+    while True:
+      gevent.sleep(self._UPDATE_SECONDS)
+      count = self._metrics.Count('iconograph_reports_total')
+      fleet_interval = self._FleetInterval((count - last_count) / self._UPDATE_SECONDS)
+      last_count = count
+      self._fleet_interval = fleet_interval
+      self._metrics.Gauge('iconograph_report_interval_seconds', fleet_interval)
+
+      for slave in list(self._websockets.slaves):
+        interval = self._watched_interval if self._Watched(slave) else fleet_interval
+        if interval == slave.report_interval:
+          continue
+        slave.report_interval = interval
+        slave.Enqueue(json.dumps({
+          'type': 'report_interval',
+          'data': {
+            'seconds': interval,
+          },
+        }))
+
+
+class INotifyHandler(pyinotify.ProcessEvent):
+  # Runs on the gevent loop. A publish run renames several files into an
+  # image type's directory; wait until it has been quiet for debounce_seconds
+  # and then send one new_manifest if manifest.json was among them.
+
+  def __init__(self, scheduler, metrics, debounce_seconds):
+    self._scheduler = scheduler
+    self._metrics = metrics
+    self._debounce_seconds = debounce_seconds
+    self._timers = {}
+    self._new_manifest = set()
 
   def process_IN_MOVED_TO(self, event):
-    if event.name != 'manifest.json':
-      return
+    self._metrics.Inc('iconograph_inotify_events_total')
     image_type = os.path.basename(event.path)
+    if event.name == 'manifest.json':
+      self._new_manifest.add(image_type)
+    timer = self._timers.get(image_type)
+    if timer:
+      timer.kill(block=False)
+    self._timers[image_type] = gevent.spawn_later(
+        self._debounce_seconds, self._Flush, image_type)
+
+  def _Flush(self, image_type):
+    del self._timers[image_type]
+    if image_type not in self._new_manifest:
+      return
+    self._new_manifest.remove(image_type)
     print('New manifest for:', image_type)
-    self._websockets.Broadcast(self._websockets, {
+    self._scheduler.NewManifest(image_type)
+
+
+class NotificationScheduler(object):
+  # Tells slaves about a new manifest in waves rather than all at once, so
+  # they don't all start multi-GB downloads in the same instant. Slaves
+  # whose rollout bucket picks the image they'd boot next anyway aren't
+  # told at all. Masters hear straight away.
+
+  _MAX_BP = 10000
+
+  def __init__(self, websockets, metrics, image_path, wave_size, wave_seconds, max_downloads):
+    self._websockets = websockets
+    self._metrics = metrics
+    self._image_path = image_path
+    self._wave_size = wave_size
+    self._wave_seconds = wave_seconds
+    self._max_downloads = max_downloads
+    self._rollouts = {}
+
+  def NewManifest(self, image_type):
+    msg = {
       'type': 'new_manifest',
       'data': {
         'image_type': image_type,
       },
-    })
+    }
+    # The signed manifest goes in the message, with the ETag that
+    # _ServeImageFile would give it, so clients needn't fetch it again.
+    wrapped, etag = self._LoadManifest(image_type)
+    if wrapped:
+      msg['data']['manifest'] = wrapped
+      msg['data']['etag'] = etag
+    self._websockets.PublishToMasters(msg, self._FilterForMaster)
+    # A newer manifest replaces whatever rollout is still in progress.
+    rollout = self._rollouts.get(image_type)
+    if rollout:
+      rollout.kill(block=False)
+    self._rollouts[image_type] = gevent.spawn(self._Rollout, image_type, wrapped, msg)
+
+  @staticmethod
+  def _FilterForMaster(msg, subscription):
+    if subscription.MatchesImageType(msg['data']['image_type']):
+      return msg
+    return None
+
+  def _LoadManifest(self, image_type):
+    path = os.path.join(self._image_path, image_type, 'manifest.json')
+    try:
+      with open(path, 'r') as fh:
+        etag = FileETag(os.fstat(fh.fileno()))
+        return json.load(fh), etag
+    except (FileNotFoundError, ValueError):
+      return None, None
+
+  def _Unwrap(self, wrapped):
+    # Our own disk, so no need to check the signature.
+    try:
+      return json.loads(wrapped['inner'])
+    except (TypeError, ValueError, KeyError):
+      return None
+
+  def _ChooseImage(self, hostname, manifest):
+    # Must match Fetcher._ChooseImage on the client.
+    hash_base = hashlib.sha256(hostname.encode('ascii'))
+    for image in manifest['images']:
+      hashobj = hash_base.copy()
+      hashobj.update(struct.pack('!L', image['timestamp']))
+      my_bp = struct.unpack('!I', hashobj.digest()[-4:])[0] % self._MAX_BP
+      if my_bp < image['rollout_‱']:
+        return image
+    return None
+
+  def _Wants(self, slave, image_type, manifest):
+    report = slave.Report()
+    if not report or not manifest or 'hostname' not in report:
+      # Can't tell, so let it decide for itself.
+      return True
+    if report.get('image_type') != image_type:
+      return False
+    image = self._ChooseImage(report['hostname'], manifest)
+    return image is not None and image['timestamp'] != report.get('next_timestamp')
+
+  def _Rollout(self, image_type, wrapped, msg):
+    manifest = self._Unwrap(wrapped)
+    serialized = {}
+    pending = [
+      slave
+      for slave in list(self._websockets.slaves)
+      if self._Wants(slave, image_type, manifest)
+    ]
+    while pending:
+      wave_size = self._wave_size or len(pending)
+      if self._max_downloads:
+        # Active downloads are open image responses, counted in
+        # _ServeImageFile.
+        while True:
+          active = self._metrics.Level('iconograph_image_downloads_active', image_type=image_type)
+          if active < self._max_downloads:
+            break
+          gevent.sleep(1.0)
+        wave_size = min(wave_size, self._max_downloads - active)
+      wave, pending = pending[:wave_size], pending[wave_size:]
+      self._websockets.PublishToSlaves(
+          [x for x in wave if x in self._websockets.slaves],
+          msg,
+          serialized)
+      self._metrics.Inc('iconograph_manifest_notifications_total', len(wave), image_type=image_type)
+      if pending:
+        gevent.sleep(self._wave_seconds)
+    if self._rollouts.get(image_type) is gevent.getcurrent():
+      del self._rollouts[image_type]
+
+
+class FileWrapper(object):
+  # WSGI response body covering length bytes of fh from its current
+  # position. WSGIHandler sends these with sendfile() when it can; any other
+  # server just iterates it. Only image bodies count as downloads; manifests
+  # and block lists are too small to matter to the rollout budget.
+
+  def __init__(self, fh, length, block_size, metrics, image_type, download):
+    self.fh = fh
+    self.offset = fh.tell()
+    self.length = length
+    self._block_size = block_size
+    self._metrics = metrics
+    self._image_type = image_type
+    self._download = download
+    if self._download:
+      self._metrics.Add('iconograph_image_downloads_active', 1, image_type=image_type)
+
+  def Sent(self, length):
+    self._metrics.Inc('iconograph_image_bytes_total', length, image_type=self._image_type)
+
+  def __iter__(self):
+    remaining = self.length
+    while remaining > 0:
+      block = self.fh.read(min(self._block_size, remaining))
+      if len(block) == 0:
+        break
+      remaining -= len(block)
+      self.Sent(len(block))
+      yield block
+
+  def close(self):
+    self.fh.close()
+    if self._download:
+      self._metrics.Add('iconograph_image_downloads_active', -1, image_type=self._image_type)
+
+
+class WebSocketApplication(wsgiutils.WebSocketWSGIApplication):
+  # ws4py echoes back every offered subprotocol it supports, but the
+  # handshake must select exactly one. Narrow the offer down to the most
+  # preferred of ours (protocols is in preference order) before it looks.
+
+  def __call__(self, environ, start_response):
+    offered = [
+      x.strip()
+      for x in environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',')
+    ]
+    environ.pop('HTTP_SEC_WEBSOCKET_PROTOCOL', None)
+    for protocol in self.protocols or []:
+      if protocol in offered:
+        environ['HTTP_SEC_WEBSOCKET_PROTOCOL'] = protocol
+        break
+    return super().__call__(environ, start_response)
+
+
+class WSGIHandler(geventserver.WebSocketWSGIHandler):
+
+  _SENDFILE_BLOCK_SIZE = 2 ** 24
+
+  def process_result(self):
+    # sendfile() bypasses the TLS layer, so it's only safe on plain sockets.
+    if (not isinstance(self.result, FileWrapper) or
+        self.server.ssl_enabled or
+        not self.server.sendfile_enabled):
+      return super().process_result()
+
+    # Send status and headers, then the body straight from the page cache.
+    self.write(b'')
+    out_fd = self.socket.fileno()
+    in_fd = self.result.fh.fileno()
+    offset = self.result.offset
+    remaining = self.result.length
+    while remaining > 0:
+      try:
+        sent = os.sendfile(out_fd, in_fd, offset, min(remaining, self._SENDFILE_BLOCK_SIZE))
+      except BlockingIOError:
+        gevent.socket.wait_write(out_fd)
+        continue
+      if sent == 0:
+        break
+      offset += sent
+      remaining -= sent
+      self.response_length += sent
+      self.result.Sent(sent)
+
+  def log_request(self):
+    path = self.environ['PATH_INFO']
+    # WebSocket requests last as long as the connection.
+    if not path.startswith('/ws/'):
+      self.server.metrics.Observe(
+          'iconograph_request_seconds',
+          self.time_finish - self.time_start,
+          path=self._PathLabel(path))
+    super().log_request()
+
+  @staticmethod
+  def _PathLabel(path):
+    # Keeps the label set small: /image/<type>, /exec/<method>, /api/<name>,
+    # and the first path component of anything else.
+    parts = path.split('/')
+    if len(parts) > 2 and parts[1] in ('api', 'exec', 'image'):
+      return '/'.join(parts[:3])
+    return '/'.join(parts[:2])
 
 
 class HTTPRequestHandler(object):
@@ -195,21 +1474,32 @@ class HTTPRequestHandler(object):
     '.woff': 'application/font-woff',
   }
   _BLOCK_SIZE = 2 ** 16
+  _RANGE_REGEX = re.compile('^bytes=(?P<start>\d*)-(?P<end>\d*)$')
 
-  def __init__(self, image_path, image_types, exec_handlers, static_paths, websockets):
+  def __init__(self, image_path, image_types, exec_handlers, exec_options, static_paths, websockets, metrics, fleet, history):
     self._image_path = image_path
     self._image_types = image_types
     self._exec_handlers = exec_handlers
+    self._exec_timeout = exec_options['timeout']
+    self._exec_cache_ttls = exec_options['cache_ttls']
+    self._exec_cache = {}
+    self._exec_semaphores = {
+      method: gevent.lock.BoundedSemaphore(exec_options['concurrency'])
+      for method in exec_handlers
+    }
     self._static_paths = static_paths
+    self._metrics = metrics
+    self._fleet = fleet
+    self._history = history
     self._static_paths['static'] = os.path.join(os.path.dirname(sys.argv[0]), 'static')
 
-    slave_ws_handler = GetSlaveWSHandler(image_types, websockets)
-    self._slave_ws_handler = wsgiutils.WebSocketWSGIApplication(
-      protocols=['iconograph-slave'],
+    slave_ws_handler = GetSlaveWSHandler(image_types, websockets, fleet)
+    self._slave_ws_handler = WebSocketApplication(
+      protocols=wire.Codec.Protocols(),
       handler_cls=slave_ws_handler)
 
-    master_ws_handler = GetMasterWSHandler(image_types, websockets)
-    self._master_ws_handler = wsgiutils.WebSocketWSGIApplication(
+    master_ws_handler = GetMasterWSHandler(image_types, websockets, fleet)
+    self._master_ws_handler = WebSocketApplication(
       protocols=['iconograph-master'],
       handler_cls=master_ws_handler)
 
@@ -226,7 +1516,14 @@ class HTTPRequestHandler(object):
 
     if path.startswith('/image/'):
       image_type, image_name = path[7:].split('/', 1)
-      return self._ServeImageFile(start_response, image_type, image_name)
+      return self._ServeImageFile(env, start_response, image_type, image_name)
+    elif path == '/metrics':
+      start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+      return [self._metrics.Render().encode('utf8')]
+    elif path == '/api/fleet':
+      return self._ServeFleet(start_response, env['QUERY_STRING'])
+    elif path == '/api/history' and self._history:
+      return self._ServeHistory(start_response, env['QUERY_STRING'])
     elif path.startswith('/exec/'):
       method = path[6:]
       return self._ServeExec(start_response, method, env['QUERY_STRING'])
@@ -243,7 +1540,38 @@ class HTTPRequestHandler(object):
       if file_name.endswith(suffix):
         return mime_type
 
-  def _ServeImageFile(self, start_response, image_type, image_name):
+  def _ParseRange(self, env, size):
+    range_header = env.get('HTTP_RANGE')
+    if not range_header:
+      return None
+    match = self._RANGE_REGEX.match(range_header)
+    if not match:
+      return None
+    if match.group('start'):
+      start = int(match.group('start'))
+      end = int(match.group('end')) if match.group('end') else size - 1
+    elif match.group('end'):
+      # Suffix range: last N bytes
+      start = max(size - int(match.group('end')), 0)
+      end = size - 1
+    else:
+      return None
+    return (start, min(end, size - 1))
+
+  def _NotModified(self, env, etag, stat):
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+      return if_none_match == '*' or etag in (x.strip() for x in if_none_match.split(','))
+    if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+      try:
+        since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+      except (TypeError, ValueError):
+        return False
+      return int(stat.st_mtime) <= since
+    return False
+
+  def _ServeImageFile(self, env, start_response, image_type, image_name):
     # Sanitize inputs
     image_type = os.path.basename(image_type)
     image_name = os.path.basename(image_name)
@@ -253,17 +1581,56 @@ class HTTPRequestHandler(object):
 
     file_path = os.path.join(self._image_path, image_type, image_name)
     try:
-      with open(file_path, 'rb') as fh:
-        start_response('200 OK', [('Content-Type', self._MIMEType(image_name))])
-        while True:
-          block = fh.read(self._BLOCK_SIZE)
-          if len(block) == 0:
-            break
-          yield block
+      fh = open(file_path, 'rb')
     except FileNotFoundError:
       start_response('404 Not found', [('Content-Type', 'text/plain')])
       return []
 
+    try:
+      stat = os.fstat(fh.fileno())
+      size = stat.st_size
+      etag = FileETag(stat)
+      headers = [
+        ('Content-Type', self._MIMEType(image_name)),
+        ('Accept-Ranges', 'bytes'),
+        ('ETag', etag),
+        ('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True)),
+      ]
+
+      if self._NotModified(env, etag, stat):
+        fh.close()
+        start_response('304 Not Modified', headers[2:])
+        return []
+
+      byte_range = None
+      if env.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = self._ParseRange(env, size)
+
+      if byte_range:
+        start, end = byte_range
+        if start > end:
+          fh.close()
+          start_response('416 Range Not Satisfiable', [
+            ('Content-Range', 'bytes */%d' % size),
+          ])
+          return []
+        headers.extend([
+          ('Content-Range', 'bytes %d-%d/%d' % (start, end, size)),
+          ('Content-Length', str(end - start + 1)),
+        ])
+        start_response('206 Partial Content', headers)
+        fh.seek(start)
+        length = end - start + 1
+      else:
+        headers.append(('Content-Length', str(size)))
+        start_response('200 OK', headers)
+        length = size
+    except:
+      fh.close()
+      raise
+
+    return FileWrapper(fh, length, self._BLOCK_SIZE, self._metrics, image_type, image_name.endswith('.iso'))
+
   def _ServeStaticFile(self, start_response, file_path, file_name):
     file_name = os.path.basename(file_name)
     assert not file_name.startswith('.')
@@ -277,64 +1644,449 @@ class HTTPRequestHandler(object):
       start_response('404 Not found', [('Content-Type', 'text/plain')])
       return []
 
+  def _ServeFleet(self, start_response, query_string):
+    # /api/fleet?image_type=X&timestamp=Y returns matching hosts' last
+    # reports. Add group_by=<indexed field> to get counts instead.
+    filters = dict(urllib.parse.parse_qsl(query_string))
+    group_by = filters.pop('group_by', None)
+    if group_by and group_by not in Fleet.INDEXED_FIELDS:
+      start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+      return [b'group_by must be one of: %s' % ', '.join(Fleet.INDEXED_FIELDS).encode('ascii')]
+
+    if group_by:
+      # With no filters this comes straight from the index.
+      hostnames = self._fleet.Query(filters) if filters else None
+      counts = self._fleet.Count(group_by, hostnames)
+      body = {
+        'group_by': group_by,
+        'counts': counts,
+        'total': sum(counts.values()),
+      }
+    else:
+      hostnames = self._fleet.Query(filters)
+      body = {
+        'hosts': {x: self._fleet.Get(x) for x in hostnames},
+        'total': len(hostnames),
+      }
+
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(body).encode('utf8')]
+
+  def _ServeHistory(self, start_response, query_string):
+    # /api/history?start=T0&end=T1[&hostname=H] returns each host's state
+    # at T0 and every recorded change up to T1.
+    args = dict(urllib.parse.parse_qsl(query_string))
+    try:
+      end = int(args.get('end', time.time()))
+      start = int(args.get('start', end - 3600))
+    except ValueError:
+      start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+      return [b'start and end must be integer timestamps']
+
+    body = self._history.Query(start, end, args.get('hostname'))
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(body).encode('utf8')]
+
   def _ServeExec(self, start_response, method, arg):
     handler = self._exec_handlers[method]
+    ttl = self._exec_cache_ttls.get(method)
+    cached = self._exec_cache.get((method, arg))
     start_response('200 OK', [])
-    proc = subprocess.Popen(
-        [handler, arg],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
-    while True:
-      block = proc.stdout.read(self._BLOCK_SIZE)
-      if len(block) == 0:
-        break
-      yield block
-    proc.wait()
+    if cached and cached[0] > time.monotonic():
+      self._metrics.Inc('iconograph_exec_cache_hits_total', method=method)
+      yield cached[1]
+      return
+
+    # Buffered, so a slow client can't hold the semaphore or run into the
+    # handler's timeout; it's written out once both are released.
+    output = []
+    with self._exec_semaphores[method]:
+      start = time.monotonic()
+      proc = gevent.subprocess.Popen(
+          [handler, arg],
+          stdout=gevent.subprocess.PIPE,
+          stderr=gevent.subprocess.STDOUT)
+      # Killing the process ends the read loop below with EOF.
+      timed_out = []
+      def _Timeout():
+        timed_out.append(True)
+        proc.kill()
+      timer = gevent.spawn_later(self._exec_timeout, _Timeout)
+      try:
+        while True:
+          block = proc.stdout.read(self._BLOCK_SIZE)
+          if len(block) == 0:
+            break
+          output.append(block)
+        proc.wait()
+      finally:
+        timer.kill(block=False)
+        if proc.poll() is None:
+          proc.kill()
+          proc.wait()
+      self._metrics.Observe('iconograph_exec_seconds', time.monotonic() - start, method=method)
+
+    output = b''.join(output)
+    if timed_out:
+      self._metrics.Inc('iconograph_exec_timeouts_total', method=method)
+    elif ttl and proc.returncode == 0:
+      now = time.monotonic()
+      self._exec_cache = {
+        key: value
+        for key, value in self._exec_cache.items()
+        if value[0] > now
+      }
+      self._exec_cache[(method, arg)] = (now + ttl, output)
+    yield output
+
+
+class Broker(object):
+  # Runs in the supervisor process with --workers. Workers connect over a
+  # Unix socket and exchange newline-delimited JSON: fleet_update messages
+  # go to every other worker, and command messages go to the worker that
+  # holds the target's slave socket.
+
+  def __init__(self, listener):
+    self._server = gevent.server.StreamServer(listener, self._Handle)
+    self._workers = set()
+    self._owners = {}
+
+  def Start(self):
+    self._server.start()
+
+  def _Handle(self, sock, address):
+    self._workers.add(sock)
+    try:
+      for line in sock.makefile('rb'):
+        parsed = json.loads(line.decode('utf8'))
+        if parsed['op'] == 'fleet_update':
+          data = parsed['msg']['data']
+          for hostname in data['targets_removed']:
+            if self._owners.get(hostname) is sock:
+              del self._owners[hostname]
+          for hostname in data['targets_added']:
+            self._owners[hostname] = sock
+          for worker in list(self._workers):
+            if worker is not sock:
+              worker.sendall(line)
+        elif parsed['op'] == 'command':
+          owner = self._owners.get(parsed['target'])
+          if owner:
+            owner.sendall(line)
+    finally:
+      self._workers.discard(sock)
+      for hostname, owner in list(self._owners.items()):
+        if owner is sock:
+          del self._owners[hostname]
+
+
+class BrokerClient(object):
+  # A worker's connection to the Broker.
+
+  def __init__(self, path, websockets, fleet):
+    self._websockets = websockets
+    self._fleet = fleet
+    self._sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.connect(path)
+
+  def Publish(self, msg):
+    self._sock.sendall(json.dumps(msg).encode('utf8') + b'\n')
+
+  def Loop(self):
+    for line in self._sock.makefile('rb'):
+      parsed = json.loads(line.decode('utf8'))
+      if parsed['op'] == 'fleet_update':
+        self._fleet.ApplyRemote(parsed['msg'])
+      elif parsed['op'] == 'command':
+        target = self._websockets.targets.get(parsed['target'])
+        if target:
+          target.Enqueue(json.dumps(parsed['msg']))
+    # The supervisor went away; take the worker down with it.
+    os._exit(1)
 
 
 class Server(object):
 
-  def __init__(self, listen_host, listen_port, server_key, server_cert, ca_cert, image_path, image_types, exec_handlers, static_paths):
-    websockets = WebSockets()
+  _LISTEN_FD_ENV = 'ICONOGRAPH_LISTEN_FD'
+
+  def __init__(self, listen_host, listen_port, server_key, server_cert, ca_cert, image_path, image_types, exec_handlers, static_paths, sendfile_enabled=True, fleet_update_seconds=1.0, history_path=None, history_segment_seconds=3600, history_detail_seconds=7 * 24 * 3600, history_snapshot_seconds=90 * 24 * 3600, history_sparse_snapshot_seconds=24 * 3600, inotify_debounce_seconds=0.5, exec_cache=None, exec_concurrency=4, exec_timeout_seconds=60.0, notify_wave_size=100, notify_wave_seconds=10.0, max_concurrent_downloads=0, report_interval_seconds=5.0, max_report_interval_seconds=60.0, watched_report_interval_seconds=1.0, max_reports_per_second=0, master_replay_events=1000, drain_timeout_seconds=600.0, reconnect_spread_seconds=30.0, heartbeat_seconds=20.0, heartbeat_timeout_seconds=60.0, reuse_port=False, broker_path=None):
+    websockets = WebSockets(master_replay_events)
+    self._websockets = websockets
+    self._broker_path = broker_path
+    self._reuse_port = reuse_port
+    self._drain_timeout = drain_timeout_seconds
+    self._reconnect_spread = reconnect_spread_seconds
+    self._greenlets = []
+    metrics = Metrics()
+    self._metrics = metrics
+    metrics.Gauge('iconograph_slaves', lambda: len(websockets.slaves))
+    metrics.Gauge('iconograph_masters', lambda: len(websockets.masters))
+    metrics.Gauge('iconograph_send_queue_depth', lambda: sum(websockets.QueueDepths()))
+    metrics.Gauge('iconograph_dropped_messages', lambda: websockets.dropped_messages)
+    metrics.Gauge('iconograph_resident_memory_bytes', self._ResidentMemory)
+    metrics.Gauge('iconograph_open_sockets', self._OpenSockets)
+    self._history = None
+    if history_path:
+      self._history = ReportHistory(history_path, history_segment_seconds, history_detail_seconds, history_snapshot_seconds, history_sparse_snapshot_seconds)
+    self._fleet = Fleet(websockets, metrics, fleet_update_seconds, self._history)
 
     wm = pyinotify.WatchManager()
-    inotify_handler = INotifyHandler(websockets)
+    scheduler = NotificationScheduler(websockets, metrics, image_path, notify_wave_size, notify_wave_seconds, max_concurrent_downloads)
+    inotify_handler = INotifyHandler(scheduler, metrics, inotify_debounce_seconds)
     self._notifier = pyinotify.Notifier(wm, inotify_handler)
+    self._watch_manager = wm
     for image_type in image_types:
       type_path = os.path.join(image_path, image_type)
       wm.add_watch(type_path, pyinotify.IN_MOVED_TO)
 
     exec_handlers = dict(x.split('=', 1) for x in (exec_handlers or []))
+    exec_options = {
+      'concurrency': exec_concurrency,
+      'timeout': exec_timeout_seconds,
+      'cache_ttls': {
+        method: float(ttl)
+        for method, ttl in (x.split('=', 1) for x in (exec_cache or []))
+      },
+    }
     static_paths = dict(x.split('=', 1) for x in (static_paths or []))
-    http_handler = HTTPRequestHandler(image_path, image_types, exec_handlers, static_paths, websockets)
+    http_handler = HTTPRequestHandler(image_path, image_types, exec_handlers, exec_options, static_paths, websockets, metrics, self._fleet, self._history)
+    ssl_args = {}
+    if server_key and server_cert:
+      ssl_args = {
+        'keyfile': server_key,
+        'certfile': server_cert,
+        'ca_certs': ca_cert,
+        'cert_reqs': ssl.CERT_REQUIRED,
+        'ssl_version': ssl.PROTOCOL_TLSv1_2,
+      }
+    listener = (listen_host, listen_port)
+    listen_fd = os.environ.pop(self._LISTEN_FD_ENV, None)
+    if listen_fd:
+      # Handed over by the process we replaced; see _Upgrade().
+      listener = gevent.socket.socket(fileno=int(listen_fd))
+      os.set_inheritable(listener.fileno(), False)
+    elif reuse_port:
+      # Every worker binds its own socket and the kernel spreads
+      # connections across them.
+      family, _, _, _, address = socket.getaddrinfo(listen_host, listen_port, 0, socket.SOCK_STREAM)[0]
+      listener = gevent.socket.socket(family, socket.SOCK_STREAM)
+      listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      listener.bind(address)
+      listener.listen(socket.SOMAXCONN)
     self._httpd = geventserver.WSGIServer(
-        (listen_host, listen_port),
+        listener,
         http_handler,
-        keyfile=server_key,
-        certfile=server_cert,
-        ca_certs=ca_cert,
-        cert_reqs=ssl.CERT_REQUIRED,
-        ssl_version=ssl.PROTOCOL_TLSv1_2)
+        handler_class=WSGIHandler,
+        **ssl_args)
+    self._report_intervals = ReportIntervalController(
+        websockets,
+        metrics,
+        report_interval_seconds,
+        max_report_interval_seconds,
+        watched_report_interval_seconds,
+        max_reports_per_second)
+    self._heartbeats = HeartbeatMonitor(websockets, metrics, heartbeat_seconds, heartbeat_timeout_seconds)
+    self._httpd.sendfile_enabled = sendfile_enabled
+    self._httpd.metrics = metrics
+
+  @staticmethod
+  def _ResidentMemory():
+    with open('/proc/self/statm', 'r') as fh:
+      return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+  @staticmethod
+  def _OpenSockets():
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+      try:
+        if os.readlink(os.path.join('/proc/self/fd', fd)).startswith('socket:'):
+          count += 1
+      except FileNotFoundError:
+        # Closed since listdir().
+        pass
+    return count
+
+  def _NotifyLoop(self):
+    fd = self._watch_manager.get_fd()
+    while True:
+      gevent.socket.wait_read(fd)
+      self._notifier.read_events()
+      self._notifier.process_events()
+
+  def _Upgrade(self):
+    # SIGHUP: replace this process with a fresh copy of server.py without
+    # dropping anything. A forked child keeps the existing connections and
+    # drains them; this pid execs the new code with the listening socket
+    # passed through, so there's no gap in accepting and the process
+    # supervisor still sees the same pid.
+    # History belongs to the new process, so whatever reports haven't been
+    # written yet go to disk first for it to restore.
+    self._fleet.Flush()
+    if self._history:
+      self._history.Flush()
+    listen_fd = self._httpd.socket.fileno()
+    pid = os.fork()
+    if pid == 0:
+      # Fork again so the drainer isn't left as our zombie after the exec.
+      if gevent.os.fork_gevent() == 0:
+        self._Drain()
+      os._exit(0)
+    try:
+      os.waitpid(pid, 0)
+    except ChildProcessError:
+      # gevent's SIGCHLD handling may have reaped it first.
+      pass
+    os.set_inheritable(listen_fd, True)
+    env = dict(os.environ)
+    env[self._LISTEN_FD_ENV] = str(listen_fd)
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+  def _Drain(self):
+    # The new process owns the listening socket, inotify, history and fleet
+    # fan-out from here on; we only see out what's already connected.
+    for greenlet in self._greenlets:
+      greenlet.kill(block=False)
+    self._httpd.stop_accepting()
+    self._httpd.socket.close()
+
+    # Masters resync from the new process's snapshot. Slaves are told when
+    # to come back, spread out so they don't all reconnect and re-check
+    # their manifest at once.
+    for master in list(self._websockets.masters):
+      master.CloseWhenSent(1001, 'server restarting')
+    for slave in list(self._websockets.slaves):
+      slave.Enqueue(json.dumps({
+        'type': 'reconnect_after',
+        'data': {
+          'seconds': random.uniform(0, self._reconnect_spread),
+        },
+      }))
+      slave.CloseWhenSent(1001, 'server restarting')
+
+    # Image downloads run to completion, up to drain_timeout.
+    deadline = time.monotonic() + self._drain_timeout
+    while time.monotonic() < deadline:
+      if not (self._metrics.Total('iconograph_image_downloads_active') or
+              self._websockets.slaves or
+              self._websockets.masters):
+        break
+      gevent.sleep(1.0)
 
   def Serve(self):
-    self._notify_thread = threading.Thread(target=self._notifier.loop)
-    self._notify_thread.daemon = True
-    self._notify_thread.start()
+    self._greenlets.append(gevent.spawn(self._NotifyLoop))
+    if self._broker_path:
+      broker = BrokerClient(self._broker_path, self._websockets, self._fleet)
+      self._fleet.SetBroker(broker)
+      self._greenlets.append(gevent.spawn(broker.Loop))
+    self._greenlets.append(gevent.spawn(self._fleet.Loop))
+    self._greenlets.append(gevent.spawn(self._report_intervals.Loop))
+    self._greenlets.append(gevent.spawn(self._heartbeats.Loop))
+    if self._history:
+      self._greenlets.append(gevent.spawn(self._history.Loop))
+    if not self._reuse_port:
+      # Pre-fork workers each bind their own socket, so there's nothing to
+      # hand over; restarting those still means restarting the Supervisor.
+      gevent.signal_handler(signal.SIGHUP, lambda: gevent.spawn(self._Upgrade))
     self._httpd.serve_forever()
 
 
+class Supervisor(object):
+  # Pre-fork mode: N Server workers share the port with SO_REUSEPORT and
+  # talk through a Broker in this process. Each worker runs its own inotify
+  # watch, so new_manifest reaches all of them. Report history is written
+  # by the first worker only; it sees every update through the broker.
+
+  def __init__(self, workers, server_args):
+    self._workers = workers
+    self._server_args = server_args
+    self._pids = []
+
+  def Serve(self):
+    broker_path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    # Bound before forking so workers can connect straight away; the broker
+    # itself only starts once they're gone, so they don't inherit its hub.
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(broker_path)
+    listener.listen(self._workers)
+
+    for i in range(self._workers):
+      pid = os.fork()
+      if pid == 0:
+        listener.close()
+        server_args = dict(self._server_args)
+        if i > 0:
+          server_args['history_path'] = None
+        # Each worker only sees its own downloads, so each gets a share of
+        # the budget.
+        if server_args.get('max_concurrent_downloads'):
+          server_args['max_concurrent_downloads'] = max(
+              server_args['max_concurrent_downloads'] // self._workers, 1)
+        Server(reuse_port=True, broker_path=broker_path, **server_args).Serve()
+        os._exit(0)
+      self._pids.append(pid)
+
+    # A plain socket; StreamServer only accepts without blocking the hub if
+    # it's non-blocking.
+    listener.setblocking(False)
+    Broker(listener).Start()
+    try:
+      # There's no state to hand a replacement worker, so if one dies, take
+      # everything down and let the process supervisor restart us.
+      while True:
+        gevent.sleep(1.0)
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+          print('Worker %d exited' % pid)
+          break
+    finally:
+      for pid in self._pids:
+        try:
+          os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+          pass
+      os.unlink(broker_path)
+
+
 def main():
-  server = Server(
-      FLAGS.listen_host,
-      FLAGS.listen_port,
-      FLAGS.server_key,
-      FLAGS.server_cert,
-      FLAGS.ca_cert,
-      FLAGS.image_path,
-      set(FLAGS.image_types),
-      FLAGS.exec_handlers,
-      FLAGS.static_paths)
-  server.Serve()
+  server_args = {
+    'listen_host': FLAGS.listen_host,
+    'listen_port': FLAGS.listen_port,
+    'server_key': FLAGS.server_key,
+    'server_cert': FLAGS.server_cert,
+    'ca_cert': FLAGS.ca_cert,
+    'image_path': FLAGS.image_path,
+    'image_types': set(FLAGS.image_types),
+    'exec_handlers': FLAGS.exec_handlers,
+    'exec_cache': FLAGS.exec_cache,
+    'exec_concurrency': FLAGS.exec_concurrency,
+    'exec_timeout_seconds': FLAGS.exec_timeout_seconds,
+    'static_paths': FLAGS.static_paths,
+    'sendfile_enabled': not FLAGS.disable_sendfile,
+    'fleet_update_seconds': FLAGS.fleet_update_seconds,
+    'history_path': FLAGS.history_path,
+    'history_segment_seconds': FLAGS.history_segment_seconds,
+    'history_detail_seconds': FLAGS.history_detail_seconds,
+    'history_snapshot_seconds': FLAGS.history_snapshot_seconds,
+    'history_sparse_snapshot_seconds': FLAGS.history_sparse_snapshot_seconds,
+    'inotify_debounce_seconds': FLAGS.inotify_debounce_seconds,
+    'notify_wave_size': FLAGS.notify_wave_size,
+    'notify_wave_seconds': FLAGS.notify_wave_seconds,
+    'max_concurrent_downloads': FLAGS.max_concurrent_downloads,
+    'report_interval_seconds': FLAGS.report_interval_seconds,
+    'max_report_interval_seconds': FLAGS.max_report_interval_seconds,
+    'watched_report_interval_seconds': FLAGS.watched_report_interval_seconds,
+    'max_reports_per_second': FLAGS.max_reports_per_second,
+    'master_replay_events': FLAGS.master_replay_events,
+    'drain_timeout_seconds': FLAGS.drain_timeout_seconds,
+    'reconnect_spread_seconds': FLAGS.reconnect_spread_seconds,
+    'heartbeat_seconds': FLAGS.heartbeat_seconds,
+    'heartbeat_timeout_seconds': FLAGS.heartbeat_timeout_seconds,
+  }
+  if FLAGS.workers > 1:
+    Supervisor(FLAGS.workers, server_args).Serve()
+  else:
+    Server(**server_args).Serve()
 
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@ let ImageController = function(container) {
   this.container_ = container;
   this.overlay_ = this.createNode_(this.container_, 'overlay');
   this.image_types_ = new Map();
+  this.reports_ = new Map();
+  this.targets_ = new Set();
 
   this.connect_();
 
@@ -11,7 +13,22 @@ let ImageController = function(container) {
 };
 
 ImageController.prototype.connect_ = function() {
-  this.ws_ = new WebSocket('wss://' + location.host + '/ws/master', 'iconograph-master');
+  // e.g. #image_types=foo,bar&hostnames=web-*,db-1 limits what the server
+  // sends us.
+  let hash = new URLSearchParams(location.hash.substring(1));
+  let params = new URLSearchParams();
+  for (let key of ['image_types', 'hostnames']) {
+    if (hash.get(key)) {
+      params.set(key, hash.get(key));
+    }
+  }
+  // Ask to pick up after the last event we saw. If the server can't, it
+  // sends a fresh snapshot instead.
+  if (this.server_id_) {
+    params.set('server_id', this.server_id_);
+    params.set('seq', this.seq_);
+  }
+  this.ws_ = new WebSocket('wss://' + location.host + '/ws/master?' + params.toString(), 'iconograph-master');
   this.ws_.addEventListener('message', (e) => this.onMessage_(JSON.parse(e.data)));
   this.ws_.addEventListener('close', (e) => this.onClose_());
 };
@@ -21,13 +38,19 @@ ImageController.prototype.onClose_ = function() {
 };
 
 ImageController.prototype.onMessage_ = function(msg) {
+  if (msg.server_id) {
+    this.server_id_ = msg.server_id;
+  }
+  if (msg.seq !== undefined) {
+    this.seq_ = msg.seq;
+  }
   switch (msg.type) {
     case 'image_types':
       return this.onImageTypes_(msg.data);
     case 'new_manifest':
       return this.onNewManifest_(msg.data);
-    case 'report':
-      return this.onReport_(msg.data);
+    case 'fleet_update':
+      return this.onFleetUpdate_(msg.data);
     case 'targets':
       return this.onTargets_(msg.data);
   }
@@ -87,7 +110,12 @@ ImageController.prototype.removeImageType_ = function(type) {
 };
 
 ImageController.prototype.onNewManifest_ = function(msg) {
-  this.fetchManifest_(this.image_types_.get(msg.image_type));
+  let type = this.image_types_.get(msg.image_type);
+  if (msg.manifest) {
+    this.onFetchManifest_(type, msg.manifest);
+  } else {
+    this.fetchManifest_(type);
+  }
 };
 
 ImageController.prototype.fetchManifest_ = function(type) {
@@ -120,6 +148,28 @@ ImageController.prototype.onFetchManifest_ = function(type, wrapper) {
   }
 };
 
+ImageController.prototype.onFleetUpdate_ = function(msg) {
+  for (let hostname in msg.reports) {
+    let update = msg.reports[hostname];
+    let report = this.reports_.get(hostname) || {};
+    Object.assign(report, update.data);
+    for (let key of update.removed) {
+      delete report[key];
+    }
+    this.reports_.set(hostname, report);
+    this.onReport_(report);
+  }
+  for (let hostname of msg.targets_added) {
+    this.targets_.add(hostname);
+  }
+  for (let hostname of msg.targets_removed) {
+    this.targets_.delete(hostname);
+  }
+  if (msg.targets_added.length || msg.targets_removed.length) {
+    this.updateLive_();
+  }
+};
+
 ImageController.prototype.onReport_ = function(msg) {
   let type = this.image_types_.get(msg.image_type);
   if (!type.instances.has(msg.hostname)) {
@@ -128,6 +178,7 @@ ImageController.prototype.onReport_ = function(msg) {
   let instance = type.instances.get(msg.hostname);
   instance.last_report_timestamp = Math.floor(Date.now() / 1000);
   instance.last_report.innerText = this.formatSeconds_(0);
+  instance.report_interval = msg.report_interval || 5;
   instance.uptime.innerText = this.formatSeconds_(msg.uptime_seconds);
   instance.timestamp.innerText = msg.timestamp;
   let volume_id_len = localStorage.getItem('volume_id_len') || Number.POSITIVE_INFINITY;
@@ -165,14 +216,22 @@ ImageController.prototype.addInstance_ = function(type, hostname) {
   instance.select.addEventListener(
       'click', (e) => this.onSelectClick_(type, hostname));
 
+  if (this.targets_.has(hostname)) {
+    instance.section.classList.add('live');
+  }
+
   type.instances.set(hostname, instance);
 };
 
 ImageController.prototype.onTargets_ = function(msg) {
-  let targets = new Set(msg.targets);
+  this.targets_ = new Set(msg.targets);
+  this.updateLive_();
+};
+
+ImageController.prototype.updateLive_ = function() {
   for (let [type, type_value] of this.image_types_) {
     for (let [instance, instance_value] of type_value.instances) {
-      if (targets.has(instance)) {
+      if (this.targets_.has(instance)) {
         instance_value.section.classList.add('live');
       } else {
         instance_value.section.classList.remove('live');
@@ -187,7 +246,7 @@ ImageController.prototype.onTick_ = function() {
     for (let [instance, instance_value] of type_value.instances) {
       let stale = now - instance_value.last_report_timestamp;
       instance_value.last_report.innerText = this.formatSeconds_(stale);
-      if (stale < 15) {
+      if (stale < Math.max(15, 3 * instance_value.report_interval)) {
         instance_value.section.classList.remove('stale');
       } else {
         instance_value.section.classList.add('stale');
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+
+import json
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from ws4py.client import threadedclient
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+
+class Client(threadedclient.WebSocketClient):
+  # Collects every message the server sends: JSON text decoded, binary
+  # frames as they are.
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.messages = queue.Queue()
+
+  def handshake_ok(self):
+    # ws4py starts the reader thread here, before connect() processes any
+    # frame that came in with the handshake, and the two race. Start it
+    # once connect() is done instead.
+    pass
+
+  def received_message(self, msg):
+    if msg.is_binary:
+      self.messages.put(msg.data)
+    else:
+      self.messages.put(json.loads(msg.data.decode('utf8')))
+
+  def Send(self, msg):
+    self.send(json.dumps(msg))
+
+  def WaitFor(self, predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return None
+      try:
+        msg = self.messages.get(timeout=remaining)
+      except queue.Empty:
+        return None
+      if predicate(msg):
+        return msg
+
+
+class ServerTestCase(unittest.TestCase):
+  # Runs a real server.py on a free loopback port.
+
+  _IMAGE_TYPE = 'test'
+  _EXTRA_ARGS = []
+
+  def setUp(self):
+    self._image_path = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self._image_path, self._IMAGE_TYPE))
+    self._port = self._FreePort()
+    args = [
+      sys.executable,
+      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+      '--listen-host', '127.0.0.1',
+      '--listen-port', str(self._port),
+      '--image-path', self._image_path,
+      '--image-type', self._IMAGE_TYPE,
+      '--ca-cert', '/dev/null',
+      '--insecure',
+      '--fleet-update-seconds', '0.1',
+    ] + self._EXTRA_ARGS
+    self._log = tempfile.TemporaryFile()
+    self._proc = subprocess.Popen(args, stdout=self._log, stderr=subprocess.STDOUT)
+    self._clients = []
+    self._WaitForPort()
+
+  def tearDown(self):
+    # Clients see the server go away and close themselves.
+    self._proc.terminate()
+    self._proc.wait()
+    for client in self._clients:
+      client._th.join()
+    self._log.close()
+    shutil.rmtree(self._image_path)
+
+  def _FreePort(self):
+    with socket.socket() as sock:
+      sock.bind(('127.0.0.1', 0))
+      return sock.getsockname()[1]
+
+  def _WaitForPort(self):
+    for _ in range(100):
+      try:
+        socket.create_connection(('127.0.0.1', self._port)).close()
+        return
+      except ConnectionRefusedError:
+        time.sleep(0.1)
+    self.fail('server did not start')
+
+  def _Log(self):
+    self._log.seek(0)
+    return self._log.read().decode('utf8')
+
+  def _Request(self, path):
+    sock = socket.create_connection(('127.0.0.1', self._port))
+    sock.sendall(('GET %s HTTP/1.0\r\n\r\n' % path).encode('ascii'))
+    return sock
+
+  def _Body(self, sock):
+    response = b''
+    while True:
+      block = sock.recv(65536)
+      if not block:
+        break
+      response += block
+    sock.close()
+    return response.partition(b'\r\n\r\n')[2]
+
+  def _Connect(self, path, protocols):
+    client = Client('ws://127.0.0.1:%d%s' % (self._port, path), protocols=protocols)
+    client.daemon = True
+    client.connect()
+    client._th.start()
+    self._clients.append(client)
+    return client
+
+  def _Slave(self, hostname):
+    slave = self._Connect('/ws/slave', ['iconograph-slave'])
+    slave.Send({
+      'type': 'report',
+      'data': {
+        'hostname': hostname,
+        'image_type': self._IMAGE_TYPE,
+        'uptime_seconds': 100,
+      },
+    })
+    return slave
+
+  def _Master(self):
+    return self._Connect('/ws/master', ['iconograph-master'])
+
+
+class HandshakeTest(ServerTestCase):
+
+  def testSelectsOneSlaveProtocol(self):
+    slave = self._Connect('/ws/slave', ['iconograph-slave', 'iconograph-slave-msgpack'])
+    self.assertEqual(len(slave.protocols), 1)
+    self.assertIn(slave.protocols[0], [b'iconograph-slave', b'iconograph-slave-msgpack'])
+
+  @unittest.skipUnless(msgpack, 'needs msgpack')
+  def testPrefersServerOrder(self):
+    # Whatever order the client offers them in.
+    slave = self._Connect('/ws/slave', ['iconograph-slave', 'iconograph-slave-msgpack-deflate'])
+    self.assertEqual(slave.protocols, [b'iconograph-slave-msgpack-deflate'])
+
+  def testIgnoresUnknownProtocols(self):
+    master = self._Connect('/ws/master', ['foo', 'iconograph-master', 'bar'])
+    self.assertEqual(master.protocols, [b'iconograph-master'])
+
+
+class HeartbeatTest(ServerTestCase):
+
+  _EXTRA_ARGS = [
+    '--heartbeat-seconds', '0.2',
+    '--heartbeat-timeout-seconds', '0.5',
+  ]
+
+  def testReapLogsOneLine(self):
+    # Completes the handshake and then never answers, like a peer that
+    # went away without closing.
+    sock = socket.create_connection(('127.0.0.1', self._port))
+    sock.sendall(
+        b'GET /ws/slave HTTP/1.1\r\n'
+        b'Host: 127.0.0.1\r\n'
+        b'Upgrade: websocket\r\n'
+        b'Connection: Upgrade\r\n'
+        b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+        b'Sec-WebSocket-Version: 13\r\n'
+        b'Sec-WebSocket-Protocol: iconograph-slave\r\n'
+        b'\r\n')
+    self.assertIn(b' 101 ', sock.recv(4096))
+    time.sleep(2.0)
+    sock.close()
+    log = self._Log()
+    self.assertIn('Connection to', log)
+    self.assertNotIn('Traceback', log)
+
+
+class ExecTest(ServerTestCase):
+
+  _EXEC_ARGS = [
+    '--exec-concurrency', '1',
+    '--exec-timeout-seconds', '5',
+  ]
+
+  def setUp(self):
+    # Writes as many zero bytes as the query string asks for.
+    self._handler_dir = tempfile.mkdtemp()
+    handler = os.path.join(self._handler_dir, 'zeros')
+    with open(handler, 'w') as fh:
+      fh.write('#!/bin/sh\nhead -c "$1" /dev/zero\n')
+    os.chmod(handler, 0o755)
+    self._EXTRA_ARGS = self._EXEC_ARGS + ['--exec-handler', 'zeros=%s' % handler]
+    super().setUp()
+
+  def tearDown(self):
+    super().tearDown()
+    shutil.rmtree(self._handler_dir)
+
+  def testOutput(self):
+    self.assertEqual(self._Body(self._Request('/exec/zeros?1000')), b'\x00' * 1000)
+
+  def testSlowClientDoesNotHoldSemaphore(self):
+    # Far more than the socket buffers hold, and never read.
+    stalled = self._Request('/exec/zeros?%d' % (64 * 2 ** 20))
+    time.sleep(0.5)
+    sock = self._Request('/exec/zeros?1000')
+    sock.settimeout(3.0)
+    self.assertEqual(self._Body(sock), b'\x00' * 1000)
+    stalled.close()
+
+
+class DownloadsTest(ServerTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._stalled = []
+
+  def tearDown(self):
+    for sock in self._stalled:
+      sock.close()
+    super().tearDown()
+
+  def _Write(self, name, size):
+    with open(os.path.join(self._image_path, self._IMAGE_TYPE, name), 'wb') as fh:
+      fh.truncate(size)
+
+  def _Stall(self, name):
+    # Far more than the socket buffers hold, and never read.
+    self._stalled.append(self._Request('/image/%s/%s' % (self._IMAGE_TYPE, name)))
+    time.sleep(0.5)
+
+  def _ActiveDownloads(self):
+    body = self._Body(self._Request('/metrics'))
+    prefix = 'iconograph_image_downloads_active{image_type="%s"} ' % self._IMAGE_TYPE
+    for line in body.decode('utf8').splitlines():
+      if line.startswith(prefix):
+        return float(line[len(prefix):])
+    return 0
+
+  def testImageCounts(self):
+    self._Write('1.iso', 64 * 2 ** 20)
+    self._Stall('1.iso')
+    self.assertEqual(self._ActiveDownloads(), 1)
+
+  def testBlockListDoesNotCount(self):
+    self._Write('1.blocks.json', 64 * 2 ** 20)
+    self._Stall('1.blocks.json')
+    self.assertEqual(self._ActiveDownloads(), 0)
+
+
+class UpgradeTest(ServerTestCase):
+
+  def setUp(self):
+    self._history_path = tempfile.mkdtemp()
+    self._EXTRA_ARGS = ['--history-path', self._history_path]
+    super().setUp()
+
+  def tearDown(self):
+    super().tearDown()
+    shutil.rmtree(self._history_path)
+
+  def _History(self, hostname):
+    body = self._Body(self._Request('/api/history?hostname=%s' % hostname))
+    return json.loads(body.decode('utf8'))
+
+  def testHistorySurvivesUpgrade(self):
+    # Reported well inside the history write interval, so it's still
+    # pending when the signal arrives.
+    slave = self._Slave('host-00')
+    master = self._Master()
+    master.WaitFor(lambda msg: msg['type'] == 'fleet_update' and 'host-00' in msg['data']['reports'])
+    time.sleep(0.5)
+    os.kill(self._proc.pid, signal.SIGHUP)
+    self.assertIsNotNone(slave.WaitFor(lambda msg: msg['type'] == 'reconnect_after'))
+    self._WaitForPort()
+    self.assertIn('host-00', json.dumps(self._History('host-00')))
+
+
+class MultiWorkerTest(ServerTestCase):
+  # With --workers, slaves are spread across processes by SO_REUSEPORT.
+  # With enough of them, both workers hold some whichever way the kernel
+  # spreads them (all 16 on one worker is a 1 in 2**15 chance).
+
+  _EXTRA_ARGS = ['--workers', '2']
+  _SLAVES = 16
+
+  def _Hostnames(self):
+    return ['host-%02d' % i for i in range(self._SLAVES)]
+
+  def _Slaves(self):
+    return {hostname: self._Slave(hostname) for hostname in self._Hostnames()}
+
+  def _WaitForFleet(self, master, hostnames):
+    seen = set()
+    def Seen(msg):
+      if msg['type'] == 'fleet_update':
+        seen.update(msg['data']['reports'])
+      return seen >= set(hostnames)
+    master.WaitFor(Seen)
+    return seen
+
+  def testMasterSeesEveryWorkersSlaves(self):
+    slaves = self._Slaves()
+    master = self._Master()
+    self.assertEqual(self._WaitForFleet(master, slaves), set(slaves))
+
+  def testCommandReachesSlaveOnAnyWorker(self):
+    slaves = self._Slaves()
+    master = self._Master()
+    self._WaitForFleet(master, slaves)
+    for hostname in slaves:
+      master.Send({
+        'type': 'command',
+        'target': hostname,
+        'data': {
+          'command': 'noop',
+        },
+      })
+    for hostname, slave in slaves.items():
+      msg = slave.WaitFor(lambda msg: msg['type'] == 'command')
+      self.assertIsNotNone(msg, hostname)
+      self.assertEqual(msg['target'], hostname)
+
+
+if __name__ == '__main__':
+  unittest.main()